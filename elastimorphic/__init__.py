@@ -1,4 +1,4 @@
-from .base import Indexable, PolymorphicIndexable, SearchManager  # noqa
+from .base import Indexable, IndexableQuerySet, PolymorphicIndexable, PolymorphicS, SearchManager  # noqa
 
 __version__ = "0.2.0"
 __all__ = [PolymorphicIndexable, SearchManager]
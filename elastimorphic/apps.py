@@ -1,7 +1,8 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.db.models.signals import post_delete, post_migrate
 
-from .base import PolymorphicIndexable
-from .models import polymorphic_indexable_registry
+from .base import Indexable, PolymorphicIndexable, unindex_deleted
+from .registry import polymorphic_indexable_registry
 
 
 class ElastimorphicConfig(AppConfig):
@@ -16,3 +17,11 @@ class ElastimorphicConfig(AppConfig):
                     polymorphic_indexable_registry.register(subclass)
                 register_subclasses(subclass)
         register_subclasses(PolymorphicIndexable)
+
+        indexables = [model for model in apps.get_models() if issubclass(model, Indexable)]
+        for model in indexables:
+            model.get_doctype()
+        post_delete.connect(unindex_deleted, dispatch_uid="elastimorphic.unindex")
+        polymorphic_indexable_registry.freeze(indexables)
+        post_migrate.connect(
+            polymorphic_indexable_registry.clear_ctypes, dispatch_uid="elastimorphic.ctypes")
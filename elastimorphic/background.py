@@ -0,0 +1,166 @@
+"""Sends elasticsearch requests from a pool of background threads, so callers don't block on them.
+
+The pool has its own Elasticsearch client (and so its own keep-alive connections), sized by
+ELASTIMORPHIC_ASYNC_POOL_SIZE. Only the HTTP requests run in the pool: anything that needs the
+database is done either before a request is submitted, or by :func:`PendingResult.get`, in the
+calling thread."""
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from elasticsearch import Elasticsearch
+
+from . import caching
+from .conf import settings
+from .connection import get_client_settings
+from .hashes import iter_actions
+from .indexing import check_bulk_response
+
+
+_pool = None
+_clients = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def check_pid():
+    """Drops the pool and clients of the parent process after a fork, since its threads and
+    sockets don't carry over."""
+    global _pool, _pid
+
+    pid = os.getpid()
+    if _pid != pid:
+        _pool = None
+        _clients.clear()
+        _pid = pid
+
+
+def get_pool():
+    """Returns the process-wide pool of background threads."""
+    global _pool
+
+    with _lock:
+        check_pid()
+        if _pool is None:
+            _pool = ThreadPool(settings.ELASTIMORPHIC_ASYNC_POOL_SIZE)
+        return _pool
+
+
+def get_async_es(urls=None, **overrides):
+    """Returns the Elasticsearch client used by background requests, for the given URLs (ES_URLS
+    by default). Like :func:`elastimorphic.connection.get_es`, but it's kept apart from the shared
+    client, with a connection pool as large as the thread pool."""
+    if urls is None:
+        urls = settings.ES_URLS
+    if isinstance(urls, basestring):
+        urls = [urls]
+    client_settings = get_client_settings()
+    client_settings["maxsize"] = settings.ELASTIMORPHIC_ASYNC_POOL_SIZE
+    client_settings.update(overrides)
+    key = (tuple(urls), tuple(sorted(client_settings.items())))
+
+    with _lock:
+        check_pid()
+        if key not in _clients:
+            _clients[key] = Elasticsearch(list(urls), **client_settings)
+        return _clients[key]
+
+
+def reset_pool():
+    """Stops the background threads and forgets the background clients."""
+    global _pool
+
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+        _clients.clear()
+
+
+class PendingResult(object):
+    """The result of a background request, with the interface of multiprocessing's AsyncResult.
+
+    `callback` is applied to the request's return value by the first call to :func:`get`, in
+    the thread calling it (so that it can use the database)."""
+
+    def __init__(self, result, callback=None):
+        self.result = result
+        self.callback = callback
+        self.done = False
+        self.value = None
+
+    def ready(self):
+        return self.result.ready()
+
+    def successful(self):
+        return self.result.successful()
+
+    def wait(self, timeout=None):
+        self.result.wait(timeout)
+
+    def get(self, timeout=None):
+        """Waits for the request, and returns its result (raising its exception if it failed)."""
+        if not self.done:
+            value = self.result.get(timeout)
+            if self.callback is not None:
+                value = self.callback(value)
+            self.value = value
+            self.done = True
+        return self.value
+
+
+class FinishedResult(object):
+    """Stands in for an AsyncResult when there was nothing to send."""
+
+    def __init__(self, value=None):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        return self.value
+
+
+def submit(func, args=(), callback=None):
+    """Calls `func(*args)` from a background thread, returning a :class:`PendingResult`."""
+    return PendingResult(get_pool().apply_async(func, args), callback)
+
+
+def send_bulk(es, chunk, count):
+    check_bulk_response(es.bulk(body=chunk))
+    return count
+
+
+def abulk(lines, es=None, chunk_size=None):
+    """Sends a list of bulk lines in chunks of `chunk_size` documents (ELASTIMORPHIC_BULK_CHUNK_SIZE
+    by default), with the chunks sent in parallel from the background threads.
+
+    Returns a :class:`PendingResult` whose `get()` returns the number of documents sent, or
+    raises a BulkIndexError if any of them failed."""
+    es = es or get_async_es()
+    chunk_size = chunk_size or settings.ELASTIMORPHIC_BULK_CHUNK_SIZE
+    chunks = []
+    for action, data in iter_actions(lines):
+        if not chunks or chunks[-1][1] == chunk_size:
+            chunks.append(([], 0))
+        chunk, count = chunks[-1]
+        chunk.extend([action] if data is None else [action, data])
+        chunks[-1] = (chunk, count + 1)
+    if not chunks:
+        return FinishedResult(0)
+    indexes = set(list(action.values())[0]["_index"] for action, data in iter_actions(lines))
+
+    def finish(counts):
+        caching.invalidate(indexes)
+        return sum(counts)
+
+    result = get_pool().map_async(lambda args: send_bulk(es, *args), chunks)
+    return PendingResult(result, finish)
@@ -1,23 +1,41 @@
-from django.db import models, DEFAULT_DB_ALIAS
+from collections import OrderedDict
+
+import django
+from django.db import models, router, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete
+from elasticsearch import NotFoundError, TransportError
 from django.template.defaultfilters import slugify
 
-from elasticutils import get_es, MappingType, S, SearchResults
+from elasticutils import MappingType, S, SearchResults
 
+from . import background, caching
 from .conf import settings
-from .models import polymorphic_indexable_registry
-from .mappings.doctype import DocumentType, search_field_factory
+from .connection import get_es
+from .hydration import get_ctype_model, hydrate, hydrate_many
+from . import hashes
+from .indexing import (
+    get_delete_action, get_index_actions, get_partial_actions, index_pks, indexing_buffer, run_on_commit)
+from .queues import get_index_queue
+from .registry import polymorphic_indexable_registry
+from .mappings.doctype import DocumentType, compile_doctype
 
 
 class ModelSearchResults(SearchResults):
     """This is a little hackey, but in this class, "type" is a polymorphic classmethod
-    that we're supposed to return results for."""
+    that we're supposed to return results for.
+
+    `objects` can be given when the instances were already loaded (see :func:`PolymorphicS.msearch`)."""
+
+    def __init__(self, type, response, results, fields, objects=None):
+        self.hydrated = objects
+        super(ModelSearchResults, self).__init__(type, response, results, fields)
 
     def set_objects(self, results):
-        ids = list(int(r["_id"]) for r in results)
-        model_objects = self.type.get_model().objects.in_bulk(ids)
-        self.objects = [
-            model_objects[id] for id in ids if id in model_objects
-        ]
+        if self.hydrated is not None:
+            self.objects = self.hydrated
+        else:
+            self.objects = hydrate(results, self.type.get_model())
 
     def __iter__(self):
         return self.objects.__iter__()
@@ -30,13 +48,19 @@ class PolymorphicS(S):
         """The base S class has "as_list" and "as_dict", and we need to add "as_models"."""
         super(PolymorphicS, self).__init__(type_=type_)
         self.as_models = False
+        self.cache_timeout = None
 
     def _clone(self, next_step=None):
         """Since we have some special stuff in this S class, we need to pass it along when we clone."""
         new = super(PolymorphicS, self)._clone(next_step=next_step)
         new.as_models = self.as_models
+        new.cache_timeout = self.cache_timeout
         return new
 
+    def get_es(self, default_builder=get_es):
+        """Returns the shared Elasticsearch client, unless other settings were given with `es()`."""
+        return super(PolymorphicS, self).get_es(default_builder=default_builder)
+
     def get_doctypes(self):
         for action, value in reversed(self.steps):
             if action == "doctypes":
@@ -62,7 +86,134 @@ class PolymorphicS(S):
     def full(self):
         """This will allow the search to return full model instances, using ModelSearchResults"""
         self.as_models = True
-        return self._clone(next_step=("values_list", ["_id"]))
+        return self._clone(next_step=("values_list", ["_id", "polymorphic_ctype"]))
+
+    @staticmethod
+    def msearch(searches):
+        """Runs a list of searches with a single `_msearch` request, and returns their results.
+
+        Each search keeps its own results, just as if it had been executed, so iterating it (or
+        calling `count()`) afterwards doesn't search again. The instances for :func:`full`
+        searches are loaded together, with one query per class across all of them. For example::
+
+            articles, videos = PolymorphicS.msearch([
+                Article.search().query(title="cats").full(),
+                Video.search().query(title="cats").full(),
+            ])
+        """
+        searches = list(searches)
+        if not searches:
+            return []
+        body = []
+        for search in searches:
+            header = {"index": ",".join(search.get_indexes())}
+            doctypes = search.get_doctypes()
+            if doctypes:
+                header["type"] = ",".join(doctypes)
+            if search.search_type:
+                header["search_type"] = search.search_type
+            body.extend([header, search.build_search()])
+        responses = searches[0].get_es().msearch(body=body)["responses"]
+
+        for search, response in zip(searches, responses):
+            if "error" in response:
+                raise TransportError(response.get("status", "N/A"), response["error"], response)
+        results = [
+            search.to_python(response.get("hits", {}).get("hits", []))
+            for search, response in zip(searches, responses)]
+        full = [i for i, search in enumerate(searches) if search.as_models]
+        hydrated = dict(zip(full, hydrate_many([(results[i], searches[i].type.get_model()) for i in full])))
+
+        for i, (search, response) in enumerate(zip(searches, responses)):
+            ResultsClass = search.get_results_class()
+            if i in hydrated:
+                search._results_cache = ResultsClass(
+                    search.type, response, results[i], search.fields, objects=hydrated[i])
+            else:
+                search._results_cache = ResultsClass(search.type, response, results[i], search.fields)
+        return [search._results_cache for search in searches]
+
+    def cached(self, timeout=None):
+        """Caches the responses to this search (and its count) for `timeout` seconds, or
+        ELASTIMORPHIC_SEARCH_CACHE_TIMEOUT. They're dropped early if any of the indexes searched
+        are written to (see :mod:`elastimorphic.caching`).
+
+        This does nothing unless ELASTIMORPHIC_SEARCH_CACHE is set. For :func:`full` searches,
+        the models are still loaded from the database each time."""
+        new = self._clone()
+        new.cache_timeout = timeout or settings.ELASTIMORPHIC_SEARCH_CACHE_TIMEOUT
+        return new
+
+    def get_cache_key(self):
+        """Returns the cache for this search's responses and its key in it, or (None, None) if
+        they aren't cached (or its indexes changed too recently)."""
+        cache = caching.get_search_cache() if self.cache_timeout else None
+        if cache is None:
+            return None, None
+        key = caching.get_search_key(
+            cache, self.build_search(), self.get_indexes(), self.get_doctypes(), self.search_type)
+        if key is None:
+            return None, None
+        return cache, key
+
+    def raw(self):
+        cache, key = self.get_cache_key()
+        if cache is None:
+            return super(PolymorphicS, self).raw()
+        response = cache.get(key)
+        if response is None:
+            response = super(PolymorphicS, self).raw()
+            cache.set(key, response, self.cache_timeout)
+        return response
+
+    def get_async_es(self):
+        """Returns the background client (see :mod:`elastimorphic.background`), with any settings
+        given with `es()`."""
+        return super(PolymorphicS, self).get_es(default_builder=background.get_async_es)
+
+    def araw(self, callback=None):
+        """Like `raw()`, but the search is sent from a background thread. Returns a result whose
+        `get()` returns the raw response, or what `callback` returns for it."""
+        cache, key = self.get_cache_key()
+        if cache is not None:
+            response = cache.get(key)
+            if response is not None:
+                return background.FinishedResult(response if callback is None else callback(response))
+
+        def finish(response):
+            if cache is not None:
+                cache.set(key, response, self.cache_timeout)
+            return response if callback is None else callback(response)
+
+        kwargs = dict(body=self.build_search(), index=self.get_indexes(), doc_type=self.get_doctypes())
+        if self.search_type:
+            kwargs["search_type"] = self.search_type
+        es = self.get_async_es()
+        return background.submit(lambda: es.search(**kwargs), callback=finish)
+
+    def aexecute(self):
+        """Like `execute()`, but the search is sent from a background thread. Returns a result
+        whose `get()` returns the SearchResults, cached on this S just as `execute()` does.
+
+        The models for :func:`full` searches are loaded by `get()`, in the thread calling it."""
+        if self._results_cache is not None:
+            return background.FinishedResult(self._results_cache)
+
+        def finish(response):
+            if self._results_cache is None:
+                ResultsClass = self.get_results_class()
+                results = self.to_python(response.get("hits", {}).get("hits", []))
+                self._results_cache = ResultsClass(self.type, response, results, self.fields)
+            return self._results_cache
+
+        return self.araw(finish)
+
+    def acount(self):
+        """Like `count()`, but the search is sent from a background thread. Returns a result
+        whose `get()` returns the count."""
+        if self._results_cache is not None:
+            return background.FinishedResult(self._results_cache.count)
+        return self[:0].araw(lambda response: response["hits"]["total"])
 
     def all(self):
         """
@@ -79,6 +230,54 @@ class PolymorphicS(S):
             return self[:count].execute()
         return self.execute()
 
+    def iterate(self, batch_size=500, scroll="5m"):
+        """Yields every result of this search, fetching `batch_size` documents per request.
+
+        Unlike :func:`all`, this walks a scroll cursor, so only one batch is held in memory
+        at a time and large result sets aren't capped by the index's result window. Results
+        have the same shape they would have when iterating this S (including :func:`full`),
+        and slicing is respected."""
+        qs = self.build_search()
+        qs.pop("from", None)
+        qs["size"] = batch_size
+        ResultsClass = self.get_results_class()
+
+        extra_search_kwargs = {}
+        if self.search_type:
+            extra_search_kwargs["search_type"] = self.search_type
+
+        es = self.get_es()
+        response = es.search(
+            body=qs,
+            index=self.get_indexes(),
+            doc_type=self.get_doctypes(),
+            scroll=scroll,
+            **extra_search_kwargs)
+
+        skip = self.start
+        remaining = None if self.stop is None else self.stop - self.start
+        try:
+            while remaining is None or remaining > 0:
+                hits = response.get("hits", {}).get("hits", [])
+                if not hits:
+                    break
+                if skip:
+                    skipped, hits = hits[:skip], hits[skip:]
+                    skip -= len(skipped)
+                if remaining is not None:
+                    hits = hits[:remaining]
+                    remaining -= len(hits)
+                if hits:
+                    results = ResultsClass(self.type, response, self.to_python(hits), self.fields)
+                    for obj in results:
+                        yield obj
+                if remaining is not None and remaining <= 0:
+                    break
+                response = es.scroll(response["_scroll_id"], scroll=scroll)
+        finally:
+            if "_scroll_id" in response:
+                es.clear_scroll(response["_scroll_id"], ignore=404)
+
 
 class PolymorphicMappingType(MappingType):
 
@@ -91,23 +290,77 @@ class PolymorphicMappingType(MappingType):
         return cls.base_polymorphic_class.get_index_name()
 
 
+class IndexableQuerySet(QuerySet):
+    """Keeps the index up to date for `update()` and `bulk_create()`, which don't call
+    :func:`Indexable.save`. The objects they change are indexed with :func:`Indexable.reindex`."""
+
+    def get_pks_by_model(self):
+        """Returns the primary keys of the objects in this queryset, by their concrete model."""
+        if not hasattr(self.model, "polymorphic_ctype"):
+            return {self.model: list(self.values_list("pk", flat=True))}
+        pks_by_model = OrderedDict()
+        for pk, ctype_id in self.values_list("pk", "polymorphic_ctype"):
+            pks_by_model.setdefault(get_ctype_model(ctype_id), []).append(pk)
+        return pks_by_model
+
+    def update(self, **kwargs):
+        if not issubclass(self.model, Indexable):
+            return super(IndexableQuerySet, self).update(**kwargs)
+        # since Django 1.7, update() takes attnames (like "author_id") as well as field names
+        attnames = {}
+        for field in self.model._meta.fields:
+            attnames[field.name] = attnames[field.attname] = field.attname
+        fields = set(attnames.get(name, name) for name in kwargs)
+        # the objects are found first, since the update could change which ones match
+        pks_by_model = self.get_pks_by_model()
+        rows = super(IndexableQuerySet, self).update(**kwargs)
+        for model, pks in pks_by_model.items():
+            model.reindex(pks, fields=fields, using=self.db)
+        return rows
+    update.alters_data = True
+
+    def bulk_create(self, objs, batch_size=None):
+        """Creates objects like `QuerySet.bulk_create()`, then indexes them.
+
+        Only objects which have their primary keys afterwards can be indexed, so with database
+        backends that don't return them, the keys need to be set beforehand."""
+        objs = list(objs)
+        for obj in objs:
+            if hasattr(obj, "pre_save_polymorphic"):
+                # this is normally done by save(), which bulk_create() skips
+                obj.pre_save_polymorphic()
+        objs = super(IndexableQuerySet, self).bulk_create(objs, batch_size=batch_size)
+        if issubclass(self.model, Indexable):
+            pks_by_model = OrderedDict()
+            for obj in objs:
+                if obj.pk is not None:
+                    pks_by_model.setdefault(obj.__class__, []).append(obj.pk)
+            for model, pks in pks_by_model.items():
+                model.reindex(pks, using=self.db)
+        return objs
+
+
 class SearchManager(models.Manager):
     """This custom Manager provides some helper methods to easily query and filter elasticsearch
-    results for polymorphic objects."""
+    results for polymorphic objects.
+
+    Its querysets are :class:`IndexableQuerySet`, so `update()` and `bulk_create()` through
+    this manager are indexed too."""
+
+    def get_queryset(self):
+        return IndexableQuerySet(self.model, using=self._db)
 
     def s(self):
-        """Returns a PolymorphicS() instance, using an ES URL from the settings, and an index
+        """Returns a PolymorphicS() instance, using the shared ES client, and an index
         from this manager's model"""
 
-        base_polymorphic_class = self.model.get_base_class()
-        type_ = type('%sMappingType' % base_polymorphic_class.__name__, (PolymorphicMappingType,), {"base_polymorphic_class": base_polymorphic_class})
-
-        return PolymorphicS(type_=type_).es(urls=settings.ES_URLS)
+        type_ = polymorphic_indexable_registry.get_mapping_type(self.model)
+        return PolymorphicS(type_=type_)
 
     @property
     def es(self):
-        """Returns an elasticsearch object, using the ES URL from the Django settings"""
-        return get_es(urls=settings.ES_URLS)
+        """Returns the shared elasticsearch object, using the ES URL from the Django settings"""
+        return get_es()
 
     def refresh(self):
         """Refreshes the index for this object"""
@@ -127,9 +380,20 @@ class SearchManager(models.Manager):
 class Indexable(object):
     """A mixing for Django's Model, allowing easy indexing and querying."""
 
+    def __init__(self, *args, **kwargs):
+        super(Indexable, self).__init__(*args, **kwargs)
+        # objects are loaded from the database with positional values, and the indexed ones are
+        # kept so that ELASTIMORPHIC_PARTIAL_UPDATES can tell what changed
+        if args and settings.ELASTIMORPHIC_PARTIAL_UPDATES:
+            tracked = self.get_tracked_fields()
+            if tracked:
+                self._loaded_state = dict(
+                    (attname, args[position]) for position, attname in tracked
+                    if position < len(args))
+
     @classmethod
     def get_es(cls):
-        return get_es(urls=settings.ES_URLS)
+        return get_es()
 
     @classmethod
     def get_mapping_type_name(cls):
@@ -137,59 +401,286 @@ class Indexable(object):
         return "%s_%s" % (cls._meta.app_label, cls._meta.model_name)
 
     @classmethod
-    def get_doctype_class(cls):
-        doctype_class = type("{}_Mapping".format(cls.__name__), (DocumentType,), {})
-        if hasattr(cls, "Mapping"):
-            doctype_class = cls.Mapping
+    def get_doctype(cls):
+        """Returns the DocumentType describing this model's documents.
 
-        exclude = getattr(doctype_class, "exclude", [])
+        It's compiled once per model, when the app is ready (or the first time it's needed)."""
+        doctype = cls.__dict__.get("_doctype")
+        if doctype is None:
+            doctype = cls._doctype = compile_doctype(cls)
+        return doctype
 
-        for field_pair in doctype_class.fields:
-            exclude.append(field_pair[0])
-
-        for field in cls._meta.fields:
-            if field.name in exclude:
-                continue
-
-            field_tuple = search_field_factory(field)
-            if field_tuple:
-                doctype_class.fields.append(field_tuple)
+    @classmethod
+    def get_doctype_class(cls):
+        return cls.get_doctype().__class__
 
-        return doctype_class
+    @classmethod
+    def is_declarative(cls):
+        """Returns True if this model's documents come straight from its DocumentType, so that
+        they can be built from database rows, without loading instances."""
+        return cls.extract_document.__func__ is Indexable.extract_document.__func__
 
     @classmethod
     def get_mapping(cls):
-        doctype_class = cls.get_doctype_class()
-
-        mapping = doctype_class().get_mapping()
+        mapping = cls.get_doctype().get_mapping()
         mapping["dynamic"] = "strict"
         mapping["_id"] = {"path": cls._meta.pk.get_attname()}
         return {cls.get_mapping_type_name(): mapping}
 
     @classmethod
     def get_index_name(cls):
-        index_prefix = slugify(settings.DATABASES[DEFAULT_DB_ALIAS].get("NAME", "bulbs"))
-        return "%s_%s" % (index_prefix, cls._meta.db_table)
+        index_name = polymorphic_indexable_registry.index_names.get(cls)
+        if index_name is None:
+            index_prefix = slugify(settings.DATABASES[DEFAULT_DB_ALIAS].get("NAME", "bulbs"))
+            index_name = "%s_%s" % (index_prefix, cls._meta.db_table)
+        return index_name
+
+    @classmethod
+    def get_last_modified_field(cls):
+        """Returns the name of the field holding when an object last changed, which lets
+        `bulk_index --since` skip older objects, or None.
+
+        By default, this is ELASTIMORPHIC_LAST_MODIFIED_FIELD, for models that have it."""
+        name = settings.ELASTIMORPHIC_LAST_MODIFIED_FIELD
+        if name and name in [field.name for field in cls._meta.fields]:
+            return name
+        return None
 
     def extract_document(self):
-        doctype_class = self.get_doctype_class()
+        return self.get_doctype().extract(self)
 
-        doctype = doctype_class()
-        document = {}
-        for name, field in doctype.fields:
-            value = getattr(self, name, None)
-            document[name] = field.to_es(value)
-        return document
+    @classmethod
+    def get_document_sources(cls):
+        """Returns a dict of each document field's name to the attname of the model field it
+        comes from, or None if some of the document doesn't come from a single model field."""
+        if "_document_sources" not in cls.__dict__:
+            sources = None
+            if cls.is_declarative():
+                attnames = set(field.attname for field in cls._meta.fields)
+                sources = dict((name, field.source or name) for name, field in cls.get_doctype().fields)
+                if not all(source in attnames for source in sources.values()):
+                    sources = None
+            cls._document_sources = sources
+        return cls._document_sources
+
+    def get_concrete_class(self):
+        """Returns this object's model, rather than the class Django makes for objects loaded
+        with `only()` or `defer()`."""
+        if self._deferred:
+            return self._meta.proxy_for_model
+        return self.__class__
+
+    @classmethod
+    def get_tracked_fields(cls):
+        """Returns the positions (among the concrete fields) and attnames of the model fields
+        whose changes ELASTIMORPHIC_PARTIAL_UPDATES looks for: the primary key and the sources of
+        the document fields. Returns None if the documents are always sent whole."""
+        if "_tracked_fields" not in cls.__dict__:
+            tracked = None
+            sources = cls.get_document_sources()
+            if sources is not None:
+                attnames = set(sources.values())
+                attnames.add(cls._meta.pk.attname)
+                tracked = tuple(
+                    (position, field.attname)
+                    for position, field in enumerate(cls._meta.concrete_fields)
+                    if field.attname in attnames)
+            cls._tracked_fields = tracked
+        return cls._tracked_fields
+
+    def get_field_values(self):
+        """Returns the current values of the fields from :func:`get_tracked_fields`."""
+        values = self.__dict__
+        return dict(
+            (attname, values[attname])
+            for position, attname in self.get_tracked_fields() or () if attname in values)
+
+    def reset_indexed_state(self):
+        """Remembers the current field values as the ones elasticsearch has."""
+        self._indexed_state = self.get_field_values()
+
+    def get_changed_fields(self):
+        """Returns the attnames of the indexed fields changed since this object was last indexed
+        (or loaded), or None if that isn't known, e.g. for new objects."""
+        state = self.__dict__.get("_indexed_state")
+        if state is None:
+            state = self.__dict__.get("_loaded_state")
+        if not state or state.get(self._meta.pk.attname) is None:
+            return None
+        values = self.__dict__
+        return set(
+            name for name, value in state.items() if name in values and values[name] != value)
+
+    @classmethod
+    def get_affected_document_fields(cls, fields):
+        """Returns the names of the document fields which come from the given model fields
+        (by attname), or None if that isn't known."""
+        sources = cls.get_document_sources()
+        if sources is None:
+            return None
+        return [name for name, attname in sources.items() if attname in fields]
+
+    def get_partial_document(self):
+        """Returns the part of this object's document affected by its changed fields, an empty
+        dict if none of it is, or None if the whole document should be sent.
+
+        Only declarative models (see :func:`is_declarative`) whose document fields all come from
+        model fields are sent in parts. Changes to nested objects aren't noticed. An empty dict
+        is only returned once this object has been indexed, since a loaded object's document
+        might never have been sent (e.g. if it was saved with `index=False`)."""
+        changed = self.get_changed_fields()
+        if changed is None:
+            return None
+        names = self.get_affected_document_fields(changed)
+        if names is None:
+            return None
+        if not names:
+            return {} if "_indexed_state" in self.__dict__ else None
+        return self.get_doctype().extract_fields(self, names)
+
+    @classmethod
+    def reindex(cls, pks, fields=None, using=None):
+        """Indexes objects of this model by primary key, e.g. after they were changed without
+        :func:`save`. They're queued with ELASTIMORPHIC_INDEX_QUEUE, and otherwise loaded and
+        sent in bulk once the current transaction commits.
+
+        `fields` are the attnames of the model fields which changed. With
+        ELASTIMORPHIC_PARTIAL_UPDATES, only the document fields coming from them are sent
+        (read as columns, unless some are nested documents), and nothing if there are none."""
+        names = None
+        if (fields is not None and settings.ELASTIMORPHIC_PARTIAL_UPDATES and
+                not settings.ELASTIMORPHIC_SKIP_UNCHANGED):
+            names = cls.get_affected_document_fields(fields)
+            if names is not None and not names:
+                return
+            doctype_fields = dict(cls.get_doctype().fields)
+            if names and any(isinstance(doctype_fields[name], DocumentType) for name in names):
+                names = None
+        queue = get_index_queue()
+        if queue is not None:
+            # the worker always sends whole documents
+            queue.put(cls, pks)
+            return
+        using = using or router.db_for_write(cls)
+        run_on_commit(using, lambda: index_pks(cls, pks, names, es=cls.get_es()))
 
     def index(self, refresh=False):
+        partial = get_partial_actions(self)
+        if partial == []:
+            # nothing that's indexed has changed
+            return
+        queue = get_index_queue()
+        if queue is not None:
+            # the es_index_worker command will take it from here
+            queue.put(self.get_concrete_class(), [self.pk])
+            return
+        if indexing_buffer.add(self, refresh=refresh):
+            # this will be sent with the rest of the batch
+            return
         es = self.get_es()
+        if partial:
+            try:
+                es.update(
+                    index=self.get_index_name(),
+                    doc_type=self.get_mapping_type_name(),
+                    id=self.pk,
+                    body=partial[1]
+                )
+            except NotFoundError:
+                # it was never indexed, so send the whole document
+                pass
+            else:
+                self.reset_indexed_state()
+                caching.invalidate([self.get_index_name()])
+                return
         doc = self.extract_document()
+        entries = None
+        if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+            lines, entries = hashes.filter_unchanged(get_index_actions(self, doc))
+            if not lines:
+                return
         es.update(
             index=self.get_index_name(),
             doc_type=self.get_mapping_type_name(),
             id=self.pk,
             body=dict(doc=doc, doc_as_upsert=True)
         )
+        caching.invalidate([self.get_index_name()])
+        if entries:
+            hashes.record(entries)
+        if settings.ELASTIMORPHIC_PARTIAL_UPDATES:
+            self.reset_indexed_state()
+
+    def aindex(self):
+        """Like :func:`index`, but the document is sent from a background thread (see
+        :mod:`elastimorphic.background`). Returns a result whose `get()` waits for it, and
+        raises any error.
+
+        The document is built before this returns, so the background thread only talks to
+        elasticsearch. Objects which are queued or batched are handled just as :func:`index`
+        does, and the returned result is already finished. The bookkeeping for
+        ELASTIMORPHIC_SKIP_UNCHANGED and ELASTIMORPHIC_PARTIAL_UPDATES is done by `get()`, so
+        it's skipped (and the document sent in full next time) if that's never called."""
+        partial = get_partial_actions(self)
+        if partial == []:
+            return background.FinishedResult()
+        queue = get_index_queue()
+        if queue is not None:
+            queue.put(self.get_concrete_class(), [self.pk])
+            return background.FinishedResult()
+        if indexing_buffer.add(self):
+            return background.FinishedResult()
+        doc = self.extract_document()
+        entries = None
+        if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+            lines, entries = hashes.filter_unchanged(get_index_actions(self, doc))
+            if not lines:
+                return background.FinishedResult()
+
+        es = background.get_async_es()
+        kwargs = dict(index=self.get_index_name(), doc_type=self.get_mapping_type_name(), id=self.pk)
+
+        def send():
+            if partial:
+                try:
+                    return es.update(body=partial[1], **kwargs)
+                except NotFoundError:
+                    # it was never indexed, so send the whole document
+                    pass
+            return es.update(body=dict(doc=doc, doc_as_upsert=True), **kwargs)
+
+        def finish(response):
+            caching.invalidate([self.get_index_name()])
+            if entries:
+                hashes.record(entries)
+            if settings.ELASTIMORPHIC_PARTIAL_UPDATES:
+                self.reset_indexed_state()
+            return response
+
+        return background.submit(send, callback=finish)
+
+    def unindex(self, refresh=False):
+        """Removes this object's document from the index.
+
+        This is called for every deleted object (including ones deleted by `QuerySet.delete()`
+        or cascades), so the removals are queued or batched just like :func:`index`."""
+        model = self.get_concrete_class()
+        queue = get_index_queue()
+        if queue is not None:
+            queue.put(model, [self.pk], op="delete")
+            return
+        if indexing_buffer.delete(self, model, self.pk, refresh=refresh):
+            return
+        self.get_es().delete(
+            index=model.get_index_name(),
+            doc_type=model.get_mapping_type_name(),
+            id=self.pk,
+            refresh=refresh,
+            ignore=404
+        )
+        caching.invalidate([model.get_index_name()])
+        if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+            hashes.record([hashes.get_entry(get_delete_action(model, self.pk), None)])
 
     def save(self, index=True, refresh=False, *args, **kwargs):
         result = super(Indexable, self).save(*args, **kwargs)
@@ -205,23 +696,33 @@ class PolymorphicIndexable(Indexable):
 
     @classmethod
     def get_base_class(cls):
+        base_class = polymorphic_indexable_registry.base_classes.get(cls)
+        if base_class is not None:
+            return base_class
         while cls.__bases__[0] != PolymorphicIndexable:
             cls = cls.__bases__[0]
         return cls
 
     @classmethod
     def get_index_name(cls):
-        index_prefix = slugify(settings.DATABASES[DEFAULT_DB_ALIAS].get("NAME", "bulbs"))
-        return "%s_%s" % (index_prefix, cls.get_base_class()._meta.db_table)
+        index_name = polymorphic_indexable_registry.index_names.get(cls)
+        if index_name is None:
+            index_prefix = slugify(settings.DATABASES[DEFAULT_DB_ALIAS].get("NAME", "bulbs"))
+            index_name = "%s_%s" % (index_prefix, cls.get_base_class()._meta.db_table)
+        return index_name
 
     @classmethod
     def get_mapping_type_names(cls, exclude_base=False):
         """Returns the mapping type name of this class and all of its descendants."""
+        names = polymorphic_indexable_registry.mapping_type_names.get(cls)
+        if names is not None:
+            return list(names[1:] if exclude_base else names)
         names = []
         if not exclude_base:
             names.append(cls.get_mapping_type_name())
         for subclass in cls.__subclasses__():
-            names.extend(subclass.get_mapping_type_names())
+            if not subclass._deferred:
+                names.extend(subclass.get_mapping_type_names())
         return names
 
     @classmethod
@@ -258,8 +759,18 @@ class PolymorphicIndexable(Indexable):
             cls.polymorphic_primary_key_name: {"type": "integer"}
         }
 
+    @classmethod
+    def is_declarative(cls):
+        return (
+            hasattr(cls, "Mapping") and
+            cls.extract_document.__func__ is PolymorphicIndexable.extract_document.__func__)
+
     @classmethod
     def get_mapping(cls):
+        if hasattr(cls, "Mapping"):
+            mapping = super(PolymorphicIndexable, cls).get_mapping()
+            mapping[cls.get_mapping_type_name()]["_all"] = {"analyzer": "html"}
+            return mapping
         return {
             cls.get_mapping_type_name(): {
                 "_id": {
@@ -296,9 +807,34 @@ class PolymorphicIndexable(Indexable):
         It's also wise to be sure that your data is properly modeled (by overriding :func:`get_mapping`), so that
         you're not letting Elasticseach decide your mappings for you.
 
+        Models with a declarative `Mapping` get their documents from it instead.
+
         .. _polymorphic_ctype id: https://github.com/chrisglass/django_polymorphic/blob/master/polymorphic/query.py#L190
         """
+        if hasattr(self, "Mapping"):
+            return super(PolymorphicIndexable, self).extract_document()
         return {
             "polymorphic_ctype": self.polymorphic_ctype_id,
             self.polymorphic_primary_key_name: self.id
-        }
\ No newline at end of file
+        }
+
+
+def unindex_deleted(sender, instance, **kwargs):
+    """Removes the documents of deleted objects.
+
+    This receives the signal of every model, since objects loaded with `only()` or `defer()` are
+    sent with the classes Django makes for them."""
+    if not isinstance(instance, Indexable):
+        return
+    # (a deferred field can't be loaded anymore)
+    ctype_id = instance.__dict__.get("polymorphic_ctype_id")
+    if isinstance(instance, PolymorphicIndexable) and ctype_id is not None:
+        if polymorphic_indexable_registry.get_ctype_id(sender) != ctype_id:
+            # this is the row of a parent class, and the subclass' own signal removes the document
+            return
+    instance.unindex()
+
+
+if django.VERSION < (1, 7):
+    # newer versions connect this in ElastimorphicConfig.ready()
+    post_delete.connect(unindex_deleted, dispatch_uid="elastimorphic.unindex")
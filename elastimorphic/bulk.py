@@ -0,0 +1,645 @@
+import datetime
+import itertools
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from Queue import Queue
+
+from django.db import connections, models
+from django.db.models import Max, Min
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from . import hashes
+from .base import PolymorphicIndexable
+from .conf import settings
+from .connection import get_es
+from .hydration import get_ctype_model, get_non_polymorphic_queryset, get_object_relations
+from .mappings.doctype import extract_columns
+
+
+def get_models_to_index(app_labels=None):
+    """Returns the PolymorphicIndexable models to index, from the given apps or all apps.
+
+    Subclasses of other models in the list are left out, since the instance_of() query for
+    their parent selects them as well."""
+    if app_labels:
+        apps = [models.get_app(app_label) for app_label in app_labels]
+    else:
+        apps = models.get_apps()
+
+    all_models_to_index = set()
+    for app in apps:
+        for model in models.get_models(app):
+            if issubclass(model, PolymorphicIndexable):
+                all_models_to_index.add(model)
+
+    models_to_index = set()
+    for model_i in all_models_to_index:
+        should_add = True
+        for model_j in all_models_to_index:
+            if model_i != model_j and issubclass(model_i, model_j):
+                should_add = False
+                break
+        if should_add:
+            models_to_index.add(model_i)
+    return sorted(models_to_index, key=lambda model: model.__name__)
+
+
+def get_queryset(model, pk_range=None, after=None, since=None):
+    """Returns the instances of a model (and its subclasses) to index.
+
+    `pk_range` is an inclusive (first, last) range of primary keys, where either end may be
+    None, and `after` skips everything up to and including that primary key. `since` leaves out
+    objects whose last-modified field (see :func:`Indexable.get_last_modified_field`) is older."""
+    queryset = model.objects.instance_of(model).order_by("pk")
+    if since is not None:
+        queryset = queryset.filter(**{"%s__gte" % model.get_last_modified_field(): since})
+    if pk_range is not None:
+        first, last = pk_range
+        if first is not None:
+            queryset = queryset.filter(pk__gte=first)
+        if last is not None:
+            queryset = queryset.filter(pk__lte=last)
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    return queryset
+
+
+def get_columns(model):
+    """Returns the (name, field) pairs of a model's documents, and the names of the model fields
+    to select for them, if its documents can be built from database rows. Otherwise, None.
+
+    That's the case for declarative models, where every document field is a database column."""
+    if not model.is_declarative():
+        return None
+    attnames = dict((field.get_attname(), field.name) for field in model._meta.fields)
+    fields = model.get_doctype().fields
+    sources = [field.source or name for name, field in fields]
+    if not all(source in attnames for source in sources):
+        return None
+    return fields, [attnames[source] for source in sources]
+
+
+def get_load_options(model):
+    """Returns the arguments to only(), select_related() and prefetch_related() that load just
+    what a model's documents need, worked out from the properties in its mapping.
+
+    Properties named after a column load that column, and object properties named after a
+    relation load the related objects along with it. Other names may be computed from anything,
+    so if there are any, every column is loaded (and the only() arguments are None)."""
+    fields = {}
+    for field in model._meta.fields:
+        fields[field.name] = fields[field.get_attname()] = field
+    relations = get_object_relations(model)
+
+    only, select_related, prefetch_related = [], [], []
+    computed = False
+    properties = model.get_mapping()[model.get_mapping_type_name()]["properties"]
+    for name in sorted(properties):
+        if name in fields:
+            only.append(fields[name].name)
+            if name in relations:
+                select_related.append(name)
+        elif name in relations:
+            prefetch_related.append(name)
+        else:
+            computed = True
+    if computed:
+        only = None
+    return only, select_related, prefetch_related
+
+
+def get_instance_queryset(model):
+    """Returns a non-polymorphic queryset of a model, loading what its documents need."""
+    queryset = get_non_polymorphic_queryset(model)
+    only, select_related, prefetch_related = get_load_options(model)
+    if only is not None:
+        queryset = queryset.only(*only)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return queryset
+
+
+def get_high_water_mark(model):
+    """Returns the newest last-modified time among a model's objects, less
+    ELASTIMORPHIC_BULK_WATERMARK_OVERLAP, or None if it has no last-modified field (or no objects).
+
+    The overlap is there because a transaction that was still open can commit rows with older
+    last-modified times afterwards."""
+    field = model.get_last_modified_field()
+    if field is None:
+        return None
+    last = get_queryset(model).aggregate(last=Max(field))["last"]
+    if last is None:
+        return None
+    return last - datetime.timedelta(seconds=settings.ELASTIMORPHIC_BULK_WATERMARK_OVERLAP)
+
+
+def get_pk_ranges(model, count, pk_range=None):
+    """Splits the primary keys of a model (optionally within a range) into at most `count`
+    inclusive ranges of equal width."""
+    bounds = get_queryset(model, pk_range).aggregate(first=Min("pk"), last=Max("pk"))
+    first, last = bounds["first"], bounds["last"]
+    if first is None:
+        return []
+    width = max((last - first + count) // count, 1)
+    return [(start, min(start + width - 1, last)) for start in range(first, last + 1, width)]
+
+
+class Checkpoint(object):
+    """Records the last primary key indexed in each range of a `bulk_index` run, in the
+    BulkIndexCheckpoint table, and the high-water mark of each model's last-modified field
+    once it's indexed, in the BulkIndexWatermark table."""
+
+    def __init__(self, index_suffix=""):
+        self.index_suffix = index_suffix
+
+    def get_label(self, model):
+        return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+    def get_queryset(self, model):
+        from .models import BulkIndexCheckpoint
+        return BulkIndexCheckpoint.objects.filter(
+            index_suffix=self.index_suffix, model=self.get_label(model))
+
+    def start(self, model, pk_ranges):
+        """Forgets any earlier run for this model, and records the ranges of a new one."""
+        from .models import BulkIndexCheckpoint
+        self.get_queryset(model).delete()
+        BulkIndexCheckpoint.objects.bulk_create([
+            BulkIndexCheckpoint(
+                index_suffix=self.index_suffix,
+                model=self.get_label(model),
+                range_start=first,
+                range_end=last)
+            for first, last in pk_ranges
+        ])
+
+    def get_pending(self, model):
+        """Returns the unfinished (pk_range, last_pk) pairs of the last run for this model, or
+        None if there's no record of one."""
+        checkpoints = list(self.get_queryset(model))
+        if not checkpoints:
+            return None
+        return [
+            ((checkpoint.range_start, checkpoint.range_end), checkpoint.last_pk)
+            for checkpoint in checkpoints if not checkpoint.done
+        ]
+
+    def update(self, model, pk_range, last_pk=None, done=False):
+        first, last = pk_range
+        values = {}
+        if last_pk is not None:
+            values["last_pk"] = last_pk
+        if done:
+            values["done"] = True
+        self.get_queryset(model).filter(range_start=first, range_end=last).update(**values)
+
+    def get_watermark(self, model):
+        """Returns the last-modified time recorded for a model, or None."""
+        from .models import BulkIndexWatermark
+        watermarks = BulkIndexWatermark.objects.filter(
+            index_suffix=self.index_suffix, model=self.get_label(model)).values_list("last_modified", flat=True)
+        return watermarks[0] if watermarks else None
+
+    def set_watermark(self, model, last_modified):
+        from .models import BulkIndexWatermark
+        # update_or_create() is new in Django 1.7
+        updated = BulkIndexWatermark.objects.filter(
+            index_suffix=self.index_suffix, model=self.get_label(model)).update(last_modified=last_modified)
+        if not updated:
+            BulkIndexWatermark.objects.create(
+                index_suffix=self.index_suffix, model=self.get_label(model), last_modified=last_modified)
+
+
+def is_rejected(result):
+    """Returns True if a bulk item failed because the cluster was too busy to take it."""
+    error = str(result.get("error", ""))
+    return (
+        result.get("status") == 429 or
+        "EsRejectedExecutionException" in error or
+        "es_rejected_execution_exception" in error
+    )
+
+
+STAGES = ("read", "extract", "serialize", "send")
+
+
+class BulkIndexer(object):
+    """Sends instances to elasticsearch in chunks, with one bulk request per chunk.
+
+    Chunks are capped both by document count and by serialized size. The count adapts to the
+    cluster: it's halved when documents are rejected or a request is slower than
+    `target_seconds`, and grows back towards `chunk_size` while requests are fast. Rejected
+    documents are retried on their own, with exponential backoff.
+
+    With `senders`, reading and extracting documents, serializing them and sending them
+    overlap, in a :class:`BulkPipeline` with that many sender threads. The time spent in each
+    stage is added up in `timings`.
+
+    With `record_hashes` (the default with ELASTIMORPHIC_SKIP_UNCHANGED), a hash of every
+    document sent is recorded, and with `only_changed`, documents whose hash was already
+    recorded are skipped."""
+
+    def __init__(self, chunk_size=None, index_suffix="", es=None, max_bytes=None,
+                 max_retries=None, retry_backoff=None, target_seconds=None, senders=0,
+                 only_changed=False, record_hashes=None):
+        self.max_chunk_size = self.chunk_size = chunk_size or settings.ELASTIMORPHIC_BULK_CHUNK_SIZE
+        self.senders = senders
+        self.only_changed = only_changed
+        if record_hashes is None:
+            record_hashes = only_changed or settings.ELASTIMORPHIC_SKIP_UNCHANGED
+        self.record_hashes = record_hashes
+        self.skipped = 0
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self.timings_lock = threading.Lock()
+        self.index_suffix = index_suffix
+        self.es = es or get_es()
+        self.max_bytes = max_bytes or settings.ELASTIMORPHIC_BULK_MAX_BYTES
+        self.max_retries = settings.ELASTIMORPHIC_BULK_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_backoff = settings.ELASTIMORPHIC_BULK_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        self.target_seconds = target_seconds or settings.ELASTIMORPHIC_BULK_TARGET_SECONDS
+
+    def get_meta(self, model, pk):
+        return {
+            "index": {
+                "_index": model.get_index_name() + self.index_suffix,
+                "_type": model.get_mapping_type_name(),
+                "_id": pk
+            }
+        }
+
+    def get_actions(self, instance):
+        return [self.get_meta(instance.__class__, instance.pk), instance.extract_document()]
+
+    def serialize(self, instance):
+        """Returns the NDJSON lines indexing an instance."""
+        return self.serialize_actions(self.get_actions(instance))
+
+    def serialize_actions(self, actions):
+        dumps = self.es.transport.serializer.dumps
+        return "".join(dumps(line) + "\n" for line in actions)
+
+    def add_time(self, stage, seconds):
+        with self.timings_lock:
+            self.timings[stage] += seconds
+
+    def iter_actions(self, instances):
+        """Yields a (pk, actions) pair for each instance, timing the reads and extraction."""
+        iterator = iter(instances)
+        while True:
+            start = time.time()
+            try:
+                instance = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time("read", time.time() - start)
+            start = time.time()
+            actions = self.get_actions(instance)
+            self.add_time("extract", time.time() - start)
+            yield instance.pk, actions
+
+    def iter_row_actions(self, queryset):
+        """Yields a (pk, actions) pair for each object in a queryset of PolymorphicIndexables.
+
+        The primary keys and content types are read first, a chunk at a time. Then each concrete
+        class in the chunk is loaded with one query: declarative models (see :func:`get_columns`)
+        as rows of just the mapped columns, turned into documents a column at a time, and
+        others as instances, with only the columns and relations their documents need (see
+        :func:`get_load_options`)."""
+        rows = queryset.values_list("pk", "polymorphic_ctype").iterator()
+        while True:
+            start = time.time()
+            chunk = list(itertools.islice(rows, self.max_chunk_size))
+            self.add_time("read", time.time() - start)
+            if not chunk:
+                return
+            pks_by_ctype = OrderedDict()
+            for pk, ctype_id in chunk:
+                pks_by_ctype.setdefault(ctype_id, []).append(pk)
+
+            actions = {}
+            for ctype_id, pks in pks_by_ctype.items():
+                model = get_ctype_model(ctype_id)
+                columns = get_columns(model)
+                start = time.time()
+                if columns is None:
+                    objects = list(get_instance_queryset(model).filter(pk__in=pks))
+                else:
+                    fields, names = columns
+                    objects = list(get_non_polymorphic_queryset(model).filter(
+                        pk__in=pks).values_list("pk", *names))
+                self.add_time("read", time.time() - start)
+
+                start = time.time()
+                if columns is None:
+                    for instance in objects:
+                        # instances with deferred fields have a class of their own
+                        meta = self.get_meta(model, instance.pk)
+                        actions[instance.pk] = [meta, instance.extract_document()]
+                else:
+                    documents = extract_columns(fields, [row[1:] for row in objects])
+                    for row, document in zip(objects, documents):
+                        actions[row[0]] = [self.get_meta(model, row[0]), document]
+                self.add_time("extract", time.time() - start)
+
+            for pk, ctype_id in chunk:
+                # objects deleted since the chunk was read are skipped
+                if pk in actions:
+                    yield pk, actions[pk]
+
+    def shrink(self):
+        self.chunk_size = max(self.chunk_size // 2, 1)
+
+    def grow(self):
+        self.chunk_size = min(self.chunk_size + max(self.chunk_size // 4, 1), self.max_chunk_size)
+
+    def send(self, docs):
+        """Sends a list of serialized documents, retrying the ones the cluster rejects.
+
+        Raises BulkIndexError if any document fails for another reason, or is still rejected
+        after `max_retries` retries."""
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                try:
+                    response = self.es.bulk(body="".join(docs))
+                finally:
+                    self.add_time("send", time.time() - start)
+            except TransportError as e:
+                if e.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                rejected = docs
+            else:
+                rejected, errors = [], []
+                for doc, item in zip(docs, response["items"]):
+                    result = list(item.values())[0]
+                    if is_rejected(result):
+                        rejected.append((doc, item))
+                    elif result.get("status", 200) > 299 or "error" in result:
+                        errors.append(item)
+                if errors:
+                    raise BulkIndexError("%i document(s) failed to index." % len(errors), errors)
+                if not rejected:
+                    elapsed = time.time() - start
+                    if elapsed > self.target_seconds:
+                        self.shrink()
+                    elif elapsed < self.target_seconds / 2:
+                        self.grow()
+                    return
+                if attempt >= self.max_retries:
+                    raise BulkIndexError(
+                        "%i document(s) were rejected." % len(rejected), [item for doc, item in rejected])
+                rejected = [doc for doc, item in rejected]
+
+            # back off, and only send what the cluster couldn't take
+            self.shrink()
+            time.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+            docs = rejected
+
+    def index(self, instances, progress=None):
+        """Indexes an iterable of instances, returning the number of documents indexed.
+
+        `progress` is called with the running total, and the primary key of the last instance
+        sent, after every chunk."""
+        return self.send_actions(self.iter_actions(instances), progress)
+
+    def index_rows(self, queryset, progress=None):
+        """Indexes a queryset of PolymorphicIndexables, like :func:`index`, but builds the
+        documents of declarative models from database rows (see :func:`iter_row_actions`)."""
+        return self.send_actions(self.iter_row_actions(queryset), progress)
+
+    def check_hashes(self, items):
+        """Adds the hash entry of each document to (pk, actions) pairs, leaving out the
+        documents which haven't changed if `only_changed` is set."""
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, self.max_chunk_size))
+            if not chunk:
+                return
+            start = time.time()
+            entries = [hashes.get_entry(*actions) for pk, actions in chunk]
+            unchanged = hashes.get_unchanged(entries) if self.only_changed else ()
+            self.add_time("read", time.time() - start)
+            for (pk, actions), entry in zip(chunk, entries):
+                if entry[0] in unchanged:
+                    self.skipped += 1
+                    continue
+                yield pk, actions, entry
+
+    def record(self, entries):
+        """Records the hashes of documents which were sent."""
+        entries = [entry for entry in entries if entry is not None]
+        if entries:
+            hashes.record(entries)
+
+    def send_actions(self, items, progress=None):
+        """Sends an iterable of (pk, actions) pairs in chunks."""
+        if self.record_hashes:
+            items = self.check_hashes(items)
+        else:
+            items = ((pk, actions, None) for pk, actions in items)
+        if self.senders:
+            return BulkPipeline(self, self.senders).run(items, progress)
+
+        num_processed = 0
+        docs = []
+        entries = []
+        size = 0
+        last_pk = None
+        for pk, actions, entry in items:
+            start = time.time()
+            doc = self.serialize_actions(actions)
+            self.add_time("serialize", time.time() - start)
+            docs.append(doc)
+            entries.append(entry)
+            size += len(doc)
+            last_pk = pk
+            if len(docs) >= self.chunk_size or size >= self.max_bytes:
+                self.send(docs)
+                self.record(entries)
+                num_processed += len(docs)
+                docs = []
+                entries = []
+                size = 0
+                if progress:
+                    progress(num_processed, last_pk)
+        if docs:
+            self.send(docs)
+            self.record(entries)
+            num_processed += len(docs)
+            if progress:
+                progress(num_processed, last_pk)
+        return num_processed
+
+
+_done = object()
+
+
+class BulkPipeline(object):
+    """Indexes instances in three overlapping stages, connected by bounded queues:
+
+    * the calling thread reads (pk, actions, hash entry) items from an iterable, which is
+      usually what extracts the documents, since that's the thread owning the database
+      connection,
+    * a serializer thread encodes the documents, and groups them into chunks,
+    * a pool of sender threads sends the chunks to elasticsearch, with at most `max_in_flight`
+      chunks waiting for them.
+
+    Progress is reported (and hashes recorded) from the calling thread, only once every earlier
+    chunk has been sent, so that the last primary key it reports is safe to resume after."""
+
+    def __init__(self, indexer, senders=2, max_in_flight=None):
+        self.indexer = indexer
+        self.senders = senders
+        self.max_in_flight = max_in_flight or senders * 2
+        self.errors = []
+
+    def run(self, items, progress=None):
+        documents = Queue(maxsize=self.indexer.max_chunk_size * self.max_in_flight)
+        chunks = Queue(maxsize=self.max_in_flight)
+        self.results = Queue()
+        self.progress = progress
+        self.num_processed = 0
+        self.next_chunk = 0
+        self.finished = {}
+
+        threads = [threading.Thread(target=self.serialize, args=(documents, chunks))]
+        for i in range(self.senders):
+            threads.append(threading.Thread(target=self.send, args=(chunks,)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for item in items:
+                if self.errors:
+                    break
+                documents.put(item)
+                self.report()
+        finally:
+            documents.put(_done)
+            for thread in threads:
+                thread.join()
+        self.report()
+        if self.errors:
+            raise self.errors[0]
+        return self.num_processed
+
+    def serialize(self, documents, chunks):
+        chunk_id = 0
+        docs = []
+        entries = []
+        size = 0
+        last_pk = None
+        while True:
+            item = documents.get()
+            if item is _done:
+                break
+            if self.errors:
+                # keep draining, so that the reading thread never blocks
+                continue
+            last_pk, actions, entry = item
+            start = time.time()
+            try:
+                doc = self.indexer.serialize_actions(actions)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            finally:
+                self.indexer.add_time("serialize", time.time() - start)
+            docs.append(doc)
+            entries.append(entry)
+            size += len(doc)
+            if len(docs) >= self.indexer.chunk_size or size >= self.indexer.max_bytes:
+                chunks.put((chunk_id, docs, entries, last_pk))
+                chunk_id += 1
+                docs = []
+                entries = []
+                size = 0
+        if docs and not self.errors:
+            chunks.put((chunk_id, docs, entries, last_pk))
+        for i in range(self.senders):
+            chunks.put(_done)
+
+    def send(self, chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is _done:
+                break
+            chunk_id, docs, entries, last_pk = chunk
+            if self.errors:
+                continue
+            try:
+                self.indexer.send(docs)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            self.results.put((chunk_id, len(docs), entries, last_pk))
+
+    def report(self):
+        while not self.results.empty():
+            chunk_id, count, entries, last_pk = self.results.get()
+            self.finished[chunk_id] = (count, entries, last_pk)
+        while self.next_chunk in self.finished:
+            count, entries, last_pk = self.finished.pop(self.next_chunk)
+            self.next_chunk += 1
+            self.indexer.record(entries)
+            self.num_processed += count
+            if self.progress:
+                self.progress(self.num_processed, last_pk)
+
+
+def close_connections():
+    """Closes this process' database connections, so that forked workers don't share them."""
+    for connection in connections.all():
+        connection.close()
+
+
+def describe_error(error):
+    if isinstance(error, BulkIndexError):
+        return "Item count mismatch. %s\nThese were rejected: %s" % (error.args[0], str(error.errors))
+    return repr(error)
+
+
+_progress_queue = None
+
+
+def init_worker(progress_queue):
+    """Sets up a worker process to report its progress to the parent through a queue."""
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def index_range(task, progress=None):
+    """Indexes one range of a model's primary keys.
+
+    This runs in worker processes, so it takes a single picklable (task_id, model, pk_range,
+    after, since, indexer_kwargs) tuple, and returns a (task_id, count, error message, timings)
+    tuple. Documents being rejected and failed requests are returned as error messages. Other
+    exceptions are raised, except in worker processes, where they're returned with their
+    traceback (which multiprocessing would lose). Progress after every chunk goes to `progress`,
+    or to the parent process."""
+    task_id, model, pk_range, after, since, indexer_kwargs = task
+    if progress is None and _progress_queue is not None:
+        def progress(count, last_pk):
+            _progress_queue.put((task_id, count, last_pk))
+
+    indexer = BulkIndexer(**indexer_kwargs)
+    queryset = get_queryset(model, pk_range, after=after, since=since)
+    try:
+        count = indexer.index_rows(queryset, progress=progress)
+    except (BulkIndexError, TransportError) as e:
+        return task_id, 0, describe_error(e), indexer.timings
+    except Exception:
+        if _progress_queue is None:
+            raise
+        return task_id, 0, traceback.format_exc(), indexer.timings
+    return task_id, count, None, indexer.timings
@@ -0,0 +1,80 @@
+"""Caches the responses of searches made with :func:`PolymorphicS.cached`, in the Django cache
+named by ELASTIMORPHIC_SEARCH_CACHE.
+
+Each index has a generation, which is part of the cache key of every search against it. It's
+replaced by :func:`invalidate` whenever documents are written to the index, so cached responses
+are dropped as soon as the index changes (or when their timeout runs out). Writes only show up in
+searches after the index refreshes, so searches within ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL
+of the last write aren't cached at all, rather than caching what the index looked like before it.
+"""
+import time
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:  # Django < 1.7
+    from django.core.cache import get_cache
+
+from .conf import settings
+from .hashes import get_document_hash
+
+
+def get_search_cache():
+    """Returns the cache for search responses, or None if ELASTIMORPHIC_SEARCH_CACHE isn't set."""
+    if settings.ELASTIMORPHIC_SEARCH_CACHE is None:
+        return None
+    return get_cache(settings.ELASTIMORPHIC_SEARCH_CACHE)
+
+
+def get_generation_key(index):
+    return "elastimorphic:generation:%s" % index
+
+
+def new_generation():
+    """Returns a new generation, which is the time it started, in microseconds.
+
+    A generation that was evicted from the cache starts again from the current time too, rather
+    than from a number that the keys of stale responses could still use."""
+    return int(time.time() * 1000000)
+
+
+def get_generations(cache, indexes):
+    """Returns the current generation of each index."""
+    keys = [get_generation_key(index) for index in indexes]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, new_generation(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def get_search_key(cache, body, indexes, doctypes=None, search_type=None):
+    """Returns the cache key for a search, which changes with the generations of its indexes, or
+    None if one of them was written to too recently for the search to be cached.
+
+    The generations are read before searching, so a response to a search that ran while its
+    index changed is stored under a key that's already out of date."""
+    indexes = sorted(indexes or [])
+    generations = get_generations(cache, indexes)
+    settled = new_generation() - settings.ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL * 1000000
+    if any(generation is None or generation > settled for generation in generations):
+        return None
+    data = [body, indexes, sorted(doctypes or []), search_type, generations]
+    return "elastimorphic:search:%s" % get_document_hash(data)
+
+
+def invalidate(indexes):
+    """Starts a new generation for some indexes, dropping the cached responses of searches on them."""
+    cache = get_search_cache()
+    if cache is None:
+        return
+    generation = new_generation()
+    cache.set_many(dict((get_generation_key(index), generation) for index in set(indexes)), None)
+
+
+def invalidate_models(models):
+    """Starts a new generation for the indexes of some Indexable models."""
+    invalidate(model.get_index_name() for model in models)
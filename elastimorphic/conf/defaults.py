@@ -40,3 +40,65 @@ ES_SETTINGS = {
         }
     }
 }
+
+# Settings for the Elasticsearch client shared by the whole process
+ELASTIMORPHIC_ES_TIMEOUT = 10
+# Number of keep-alive HTTP connections kept open per node
+ELASTIMORPHIC_ES_MAXSIZE = 10
+ELASTIMORPHIC_ES_MAX_RETRIES = 3
+ELASTIMORPHIC_ES_SNIFF_ON_START = False
+ELASTIMORPHIC_ES_SNIFF_ON_CONNECTION_FAIL = False
+# Seconds between automatic sniffs of the cluster's nodes, or None to disable
+ELASTIMORPHIC_ES_SNIFFER_TIMEOUT = None
+
+# Number of documents sent in each bulk request
+ELASTIMORPHIC_BULK_CHUNK_SIZE = 250
+# Defer indexing done inside a database transaction until it commits, and send it in bulk.
+# Requires Django 1.9+ or django-transaction-hooks; otherwise ImproperlyConfigured is raised.
+ELASTIMORPHIC_INDEX_ON_COMMIT = False
+
+# Dotted path to a queue backend (e.g. "elastimorphic.queues.DatabaseQueue"). When set,
+# Indexable.index() queues work for the es_index_worker command instead of calling ES itself.
+ELASTIMORPHIC_INDEX_QUEUE = None
+# Seconds a worker has to process the items it takes from the queue, before they're handed to
+# another worker
+ELASTIMORPHIC_INDEX_QUEUE_LEASE = 300
+
+# bulk_index caps each request at this many bytes of serialized documents
+ELASTIMORPHIC_BULK_MAX_BYTES = 10 * 1024 * 1024
+# bulk_index halves its chunk size when a request takes longer than this many seconds
+ELASTIMORPHIC_BULK_TARGET_SECONDS = 2.0
+# Documents the cluster rejects as too busy are retried this many times, waiting
+# ELASTIMORPHIC_BULK_RETRY_BACKOFF seconds, doubled after each attempt
+ELASTIMORPHIC_BULK_MAX_RETRIES = 5
+ELASTIMORPHIC_BULK_RETRY_BACKOFF = 0.5
+
+# Keep a hash of the last document sent for every object (in the IndexedDocument table), and
+# don't send documents again until they change. Documents are then sent once database
+# transactions commit, if Django 1.9+ or django-transaction-hooks provides on_commit.
+ELASTIMORPHIC_SKIP_UNCHANGED = False
+
+# Remember the field values of loaded and indexed objects, and only send the parts of their
+# documents which changed when they're saved (objects whose indexed fields didn't change since
+# they were last indexed aren't sent)
+ELASTIMORPHIC_PARTIAL_UPDATES = False
+
+# The name of the DateTimeField recording when objects last changed, used by `bulk_index --since`
+# (models can also override Indexable.get_last_modified_field())
+ELASTIMORPHIC_LAST_MODIFIED_FIELD = None
+# Seconds subtracted from the newest last-modified time that `bulk_index` records, so that
+# `--since checkpoint` still catches rows committed later by transactions open during the run
+ELASTIMORPHIC_BULK_WATERMARK_OVERLAP = 300
+
+# Number of threads (and keep-alive connections per node) used by the background client behind
+# PolymorphicS.aexecute(), acount(), Indexable.aindex() and background.abulk()
+ELASTIMORPHIC_ASYNC_POOL_SIZE = 10
+
+# The name of the Django cache (in CACHES) holding the responses of searches made with
+# PolymorphicS.cached(), or None to disable caching them
+ELASTIMORPHIC_SEARCH_CACHE = None
+# Seconds that cached search responses are kept, unless cached() is given a timeout
+ELASTIMORPHIC_SEARCH_CACHE_TIMEOUT = 60
+# Seconds elasticsearch takes to make writes searchable (the indexes' refresh_interval).
+# Searches on an index written to more recently than this aren't cached.
+ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL = 1.0
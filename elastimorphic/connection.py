@@ -0,0 +1,60 @@
+import os
+import threading
+
+from elasticsearch import Elasticsearch
+
+from .conf import settings
+
+
+_clients = {}
+_clients_pid = None
+_lock = threading.Lock()
+
+
+def get_client_settings():
+    """Returns the keyword arguments used to build the shared Elasticsearch client."""
+    return {
+        "timeout": settings.ELASTIMORPHIC_ES_TIMEOUT,
+        "maxsize": settings.ELASTIMORPHIC_ES_MAXSIZE,
+        "max_retries": settings.ELASTIMORPHIC_ES_MAX_RETRIES,
+        "sniff_on_start": settings.ELASTIMORPHIC_ES_SNIFF_ON_START,
+        "sniff_on_connection_fail": settings.ELASTIMORPHIC_ES_SNIFF_ON_CONNECTION_FAIL,
+        "sniffer_timeout": settings.ELASTIMORPHIC_ES_SNIFFER_TIMEOUT,
+    }
+
+
+def get_es(urls=None, **overrides):
+    """Returns the process-wide Elasticsearch client for the given URLs (ES_URLS by default).
+
+    Clients are keyed by their URLs and settings, so every caller asking for the same cluster
+    shares one pool of keep-alive connections. The cache is dropped when the process id changes,
+    so forked workers never share sockets with their parent."""
+    global _clients_pid
+
+    if urls is None:
+        urls = settings.ES_URLS
+    if isinstance(urls, basestring):
+        urls = [urls]
+    client_settings = get_client_settings()
+    client_settings.update(overrides)
+    key = (tuple(urls), tuple(sorted(client_settings.items())))
+
+    pid = os.getpid()
+    if _clients_pid == pid:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+
+    with _lock:
+        if _clients_pid != pid:
+            _clients.clear()
+            _clients_pid = pid
+        if key not in _clients:
+            _clients[key] = Elasticsearch(list(urls), **client_settings)
+        return _clients[key]
+
+
+def reset_es():
+    """Forgets all cached clients, e.g. after changing the ELASTIMORPHIC_ES_* settings in tests."""
+    with _lock:
+        _clients.clear()
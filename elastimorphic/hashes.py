@@ -0,0 +1,112 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.db import transaction
+from elasticsearch.serializer import JSONSerializer
+
+
+# the number of objects looked up or recorded in each query
+CHUNK_SIZE = 500
+
+_serializer = JSONSerializer()
+
+
+def get_document_hash(document):
+    """Returns a hash of a document, which doesn't depend on the order of its keys."""
+    data = json.dumps(document, sort_keys=True, separators=(",", ":"), default=_serializer.default)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def get_entry(action, body):
+    """Returns the ((index, doc_type, id), hash) entry for a bulk action and its data line.
+
+    Delete actions (which have no data line) get a hash of None."""
+    op, meta = list(action.items())[0]
+    key = (meta["_index"], meta["_type"], unicode(meta["_id"]))
+    if op == "delete":
+        return key, None
+    document = body["doc"] if op == "update" else body
+    return key, get_document_hash(document)
+
+
+def iter_actions(lines):
+    """Yields the (action, data line) pairs in a list of bulk lines, with None as the data line
+    of delete actions."""
+    lines = iter(lines)
+    for action in lines:
+        if "delete" in action:
+            yield action, None
+        else:
+            yield action, next(lines)
+
+
+def get_unchanged(entries):
+    """Returns the set of keys whose hash is the one recorded for them."""
+    from .models import IndexedDocument
+
+    ids_by_type = OrderedDict()
+    for (index, doc_type, object_id), digest in entries:
+        ids_by_type.setdefault((index, doc_type), []).append(object_id)
+
+    recorded = {}
+    for (index, doc_type), ids in ids_by_type.items():
+        for start in range(0, len(ids), CHUNK_SIZE):
+            rows = IndexedDocument.objects.filter(
+                index=index, doc_type=doc_type, object_id__in=ids[start:start + CHUNK_SIZE]
+            ).values_list("object_id", "hash")
+            for object_id, digest in rows:
+                recorded[(index, doc_type, object_id)] = digest
+    return set(key for key, digest in entries if digest is not None and recorded.get(key) == digest)
+
+
+def filter_unchanged(lines):
+    """Drops the actions for documents which haven't changed since they were last recorded,
+    from a list of bulk lines.
+
+    Returns the remaining lines, and the entries to :func:`record` once they've been sent.
+    Delete actions are always kept."""
+    pairs = list(iter_actions(lines))
+    entries = [get_entry(action, body) for action, body in pairs]
+    unchanged = get_unchanged(entries)
+
+    remaining = []
+    changed = []
+    for (action, body), entry in zip(pairs, entries):
+        if entry[1] is None or entry[0] not in unchanged:
+            remaining.append(action)
+            if body is not None:
+                remaining.append(body)
+            changed.append(entry)
+    return remaining, changed
+
+
+def record(entries):
+    """Records the hashes of documents which were sent, and forgets the ones of documents
+    which were deleted (whose hash is None)."""
+    from .models import IndexedDocument
+
+    latest = OrderedDict(entries)
+    ids_by_type = OrderedDict()
+    for index, doc_type, object_id in latest:
+        ids_by_type.setdefault((index, doc_type), []).append(object_id)
+
+    with transaction.atomic(using=IndexedDocument.objects.db):
+        for (index, doc_type), ids in ids_by_type.items():
+            for start in range(0, len(ids), CHUNK_SIZE):
+                chunk = ids[start:start + CHUNK_SIZE]
+                IndexedDocument.objects.filter(
+                    index=index, doc_type=doc_type, object_id__in=chunk).delete()
+                IndexedDocument.objects.bulk_create([
+                    IndexedDocument(
+                        index=index, doc_type=doc_type, object_id=object_id,
+                        hash=latest[(index, doc_type, object_id)])
+                    for object_id in chunk if latest[(index, doc_type, object_id)] is not None
+                ])
+
+
+def forget(indexes):
+    """Forgets the hashes recorded for some indexes, e.g. when an alias is moved."""
+    from .models import IndexedDocument
+
+    IndexedDocument.objects.filter(index__in=list(indexes)).delete()
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+from .registry import polymorphic_indexable_registry
+
+try:
+    from django.db.models import prefetch_related_objects
+except ImportError:  # Django < 1.10
+    from django.db.models.query import prefetch_related_objects as _prefetch_related_objects
+
+    def prefetch_related_objects(instances, *lookups):
+        _prefetch_related_objects(instances, lookups)
+
+
+def get_hit_ctype_id(hit):
+    """Returns the polymorphic_ctype id stored in a search hit, or None if it wasn't fetched."""
+    value = None
+    for source in ("fields", "_source"):
+        if value is None:
+            value = hit.get(source, {}).get("polymorphic_ctype")
+    # Elasticsearch 1.x returns all requested fields as lists
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    return value
+
+
+def get_ctype_model(ctype_id):
+    """Returns the concrete model class for a polymorphic_ctype id."""
+    return polymorphic_indexable_registry.get_ctype_model(ctype_id)
+
+
+def get_hit_model(hit):
+    """Returns the concrete model class of a search hit, going by its mapping type, or else its
+    polymorphic_ctype. Returns None if neither is known."""
+    klass = polymorphic_indexable_registry.get_mapping_type_model(hit.get("_type"))
+    if klass is None:
+        ctype_id = get_hit_ctype_id(hit)
+        if ctype_id is not None:
+            klass = get_ctype_model(ctype_id)
+    return klass
+
+
+def get_non_polymorphic_queryset(model):
+    queryset = model._default_manager.all()
+    if hasattr(queryset, "non_polymorphic"):
+        queryset = queryset.non_polymorphic()
+    return queryset
+
+
+def hydrate(hits, model):
+    """Returns model instances for a list of search hits, in the order of the hits.
+
+    Hits are grouped by their concrete class (see :func:`get_hit_model`), and each class is
+    loaded with a single, non-polymorphic query. Hits of unknown classes fall back to a
+    polymorphic query against `model`. Hits whose objects no longer exist in the database are
+    dropped."""
+    return hydrate_many([(hits, model)])[0]
+
+
+def hydrate_many(searches):
+    """Like :func:`hydrate`, for a list of (hits, model) pairs, returning a list of instances
+    for each pair. Each class is loaded with one query across all of the pairs."""
+    keys = []
+    ids_by_class = OrderedDict()
+    for hits, model in searches:
+        search_keys = []
+        for hit in hits:
+            pk = int(hit["_id"])
+            klass = get_hit_model(hit)
+            # hits of unknown classes are loaded through their search's model
+            key = (klass or model, klass is None, pk)
+            search_keys.append(key)
+            ids_by_class.setdefault(key[:2], []).append(pk)
+        keys.append(search_keys)
+
+    objects = {}
+    for (klass, polymorphic), ids in ids_by_class.items():
+        if polymorphic:
+            found = klass._default_manager.in_bulk(ids)
+        else:
+            found = get_non_polymorphic_queryset(klass).in_bulk(ids)
+        for pk, obj in found.items():
+            objects[(klass, polymorphic, pk)] = obj
+
+    return [[objects[k] for k in ks if k in objects] for ks in keys]
+
+
+_object_relations = {}
+
+
+def get_object_relations(model):
+    """Returns the names of the relations that a model's documents embed as objects."""
+    if model not in _object_relations:
+        opts = model._meta
+        relations = set(field.name for field in opts.fields if field.rel is not None)
+        relations.update(field.name for field in opts.many_to_many)
+        relations.update(
+            related.get_accessor_name() for related in
+            opts.get_all_related_objects() + opts.get_all_related_many_to_many_objects())
+        properties = model.get_mapping()[model.get_mapping_type_name()]["properties"]
+        _object_relations[model] = [
+            name for name, definition in sorted(properties.items())
+            if "properties" in definition and name in relations
+        ]
+    return _object_relations[model]
+
+
+def prefetch_related_documents(instances):
+    """Loads the related objects embedded in the documents of some instances, with one query
+    per relation, rather than one per instance."""
+    instances_by_class = OrderedDict()
+    for instance in instances:
+        model = instance.__class__
+        if getattr(instance, "_deferred", False):
+            model = model._meta.proxy_for_model
+        instances_by_class.setdefault(model, []).append(instance)
+    for model, group in instances_by_class.items():
+        relations = get_object_relations(model)
+        if relations:
+            prefetch_related_objects(group, *relations)
@@ -0,0 +1,401 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from elasticsearch.helpers import BulkIndexError
+
+from . import caching, hashes
+from .conf import settings
+from .connection import get_es
+from .hydration import get_non_polymorphic_queryset, prefetch_related_documents
+from .mappings.doctype import extract_columns
+
+
+def get_action(op, model, pk):
+    return {
+        op: {
+            "_index": model.get_index_name(),
+            "_type": model.get_mapping_type_name(),
+            "_id": pk
+        }
+    }
+
+
+def get_update_action(instance):
+    return get_action("update", instance.__class__, instance.pk)
+
+
+def get_delete_action(model, pk):
+    """Returns the bulk action removing the document of a model's object."""
+    return get_action("delete", model, pk)
+
+
+def get_index_actions(instance, document=None):
+    """Returns the bulk action/data lines that index a single instance.
+
+    This mirrors :func:`Indexable.index`, upserting the extracted document."""
+    if document is None:
+        document = instance.extract_document()
+    return [get_update_action(instance), dict(doc=document, doc_as_upsert=True)]
+
+
+def get_partial_actions(instance):
+    """Returns the bulk lines updating just the part of an instance's document which changed,
+    an empty list if none of it did, or None if the whole document should be sent.
+
+    This needs ELASTIMORPHIC_PARTIAL_UPDATES. With ELASTIMORPHIC_SKIP_UNCHANGED, documents
+    which changed are sent whole, since the hashes that keeps are of whole documents."""
+    if not settings.ELASTIMORPHIC_PARTIAL_UPDATES:
+        return None
+    document = instance.get_partial_document()
+    if document is None:
+        return None
+    if not document:
+        return []
+    if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+        return None
+    return [get_update_action(instance), dict(doc=document)]
+
+
+def check_bulk_response(response, partial=None, offset=0):
+    """Raises a BulkIndexError if any of the items in a bulk response failed.
+
+    `partial` maps the positions of partial updates (counting from `offset`) to their instances.
+    Those instances are returned if their documents weren't in the index yet, since they need
+    to be sent in full instead. Deleting documents which are already gone isn't an error."""
+    errors = []
+    missing = []
+    for position, item in enumerate(response.get("items", []), offset):
+        op, result = list(item.items())[0]
+        if op == "delete" and result.get("status") == 404:
+            continue
+        if result.get("status", 200) > 299 or "error" in result:
+            if partial and position in partial and result.get("status") == 404:
+                missing.append(partial[position])
+            else:
+                errors.append(item)
+    if errors:
+        raise BulkIndexError("%i document(s) failed to index." % len(errors), errors)
+    return missing
+
+
+def index_pks(model, pks, names=None, es=None):
+    """Indexes the objects of a model with the given primary keys, loading and sending
+    ELASTIMORPHIC_BULK_CHUNK_SIZE of them at a time.
+
+    If `names` is given, only those document fields are sent, as partial updates. They're read
+    as columns (see :func:`Indexable.get_document_sources`), and documents which weren't in the
+    index yet are sent in full instead."""
+    es = es or get_es()
+    chunk_size = settings.ELASTIMORPHIC_BULK_CHUNK_SIZE
+    for start in range(0, len(pks), chunk_size):
+        queryset = get_non_polymorphic_queryset(model).filter(pk__in=pks[start:start + chunk_size])
+        payload = []
+        partial = {}
+        if names is None:
+            instances = list(queryset)
+            prefetch_related_documents(instances)
+            for instance in instances:
+                payload.extend(get_index_actions(instance))
+        else:
+            sources = model.get_document_sources()
+            fields = [(name, field) for name, field in model.get_doctype().fields if name in names]
+            rows = list(queryset.values_list("pk", *[sources[name] for name, field in fields]))
+            documents = extract_columns(fields, [row[1:] for row in rows])
+            for position, (row, document) in enumerate(zip(rows, documents)):
+                partial[position] = row[0]
+                payload.extend([get_action("update", model, row[0]), dict(doc=document)])
+        entries = None
+        if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+            payload, entries = hashes.filter_unchanged(payload)
+        if not payload:
+            continue
+        missing = check_bulk_response(es.bulk(body=payload), partial)
+        if missing:
+            # these were never indexed, so they need their whole documents
+            index_pks(model, missing, es=es)
+        if entries:
+            hashes.record(entries)
+    caching.invalidate_models([model])
+
+
+class IndexingBatch(object):
+    """A set of instances waiting to be indexed with a single bulk request.
+
+    Saving the same object more than once only indexes it once, with its latest state, and
+    documents of deleted objects are removed with delete actions. Objects saved or deleted inside
+    a savepoint are read from the database again when the batch is sent, since the savepoint may
+    have been rolled back."""
+
+    def __init__(self):
+        self.instances = OrderedDict()
+        self.deleted = OrderedDict()
+        self.savepointed = set()
+        self.refresh = False
+
+    def __len__(self):
+        return len(self.instances) + len(self.deleted)
+
+    def add(self, instance, refresh=False, savepoint=False):
+        key = (instance.__class__, instance.pk)
+        self.deleted.pop(key, None)
+        # re-insert, so that the order reflects the last save
+        self.instances.pop(key, None)
+        self.instances[key] = instance
+        self.mark(key, savepoint)
+        self.refresh = self.refresh or refresh
+
+    def delete(self, instance, model, pk, refresh=False, savepoint=False):
+        """Adds the removal of a deleted instance's document, indexed as `model` with `pk`
+        (Django clears the pk of deleted instances)."""
+        key = (model, pk)
+        self.instances.pop(key, None)
+        self.deleted[key] = instance
+        self.mark(key, savepoint)
+        self.refresh = self.refresh or refresh
+
+    def mark(self, key, savepoint):
+        if savepoint:
+            self.savepointed.add(key)
+        else:
+            self.savepointed.discard(key)
+
+    def clear(self):
+        self.instances.clear()
+        self.deleted.clear()
+        self.savepointed.clear()
+        self.refresh = False
+
+    def reload_savepointed(self):
+        """Replaces the objects saved or deleted inside savepoints with their rows as they are now.
+
+        Objects whose rows are gone are dropped (they were created in a savepoint that was rolled
+        back), and deletions whose rows are still there are indexed instead. Returns the keys of
+        the objects which were reloaded."""
+        pks_by_model = OrderedDict()
+        for model, pk in self.savepointed:
+            pks_by_model.setdefault(model, []).append(pk)
+        reloaded = set()
+        for model, pks in pks_by_model.items():
+            concrete = model._meta.proxy_for_model if getattr(model, "_deferred", False) else model
+            found = get_non_polymorphic_queryset(concrete).in_bulk(pks)
+            for pk in pks:
+                key = (model, pk)
+                self.instances.pop(key, None)
+                if pk in found:
+                    self.deleted.pop(key, None)
+                    self.instances[key] = found[pk]
+                    reloaded.add(key)
+        self.savepointed.clear()
+        return reloaded
+
+    def get_delete_actions(self):
+        """Returns the delete actions for this batch, grouped by index and mapping type."""
+        pks_by_type = OrderedDict()
+        for model, pk in self.deleted:
+            key = (model.get_index_name(), model.get_mapping_type_name())
+            pks_by_type.setdefault(key, (model, []))[1].append(pk)
+        return [get_delete_action(model, pk) for model, pks in pks_by_type.values() for pk in pks]
+
+    def get_actions(self, partial=None, full=()):
+        """Yields the bulk lines for this batch. Instances sent as partial updates are added
+        to `partial`, by their position, and the ones whose keys are in `full` are sent whole."""
+        position = 0
+        for key, instance in self.instances.items():
+            lines = None if key in full else get_partial_actions(instance)
+            if lines is None:
+                lines = get_index_actions(instance)
+            elif lines and partial is not None:
+                partial[position] = instance
+            for line in lines:
+                yield line
+            position += len(lines) // 2
+
+    def flush(self, es=None):
+        """Sends everything in this batch to elasticsearch, in chunks of
+        ELASTIMORPHIC_BULK_CHUNK_SIZE documents."""
+        if not self:
+            return
+        es = es or get_es()
+        chunk_size = settings.ELASTIMORPHIC_BULK_CHUNK_SIZE
+        full = self.reload_savepointed() if self.savepointed else set()
+        instances = list(self.instances.values())
+        models = set(model for model, pk in list(self.instances) + list(self.deleted))
+        prefetch_related_documents(instances)
+        partial = {}
+        payload = list(self.get_actions(partial, full))
+        deletes = self.get_delete_actions()
+        refresh = self.refresh
+        self.clear()
+        entries = None
+        if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+            payload, entries = hashes.filter_unchanged(payload)
+            entries.extend(hashes.get_entry(action, None) for action in deletes)
+
+        # deletes have no data lines, so they're sent in their own requests
+        chunks = [(deletes[start:start + chunk_size], None, 0) for start in range(0, len(deletes), chunk_size)]
+        chunks.extend(
+            (payload[start:start + chunk_size * 2], partial, start // 2)
+            for start in range(0, len(payload), chunk_size * 2))
+        missing = []
+        for i, (chunk, chunk_partial, offset) in enumerate(chunks):
+            if refresh and i == len(chunks) - 1:
+                response = es.bulk(body=chunk, refresh=True)
+            else:
+                response = es.bulk(body=chunk)
+            missing.extend(check_bulk_response(response, chunk_partial, offset))
+        if missing:
+            # these were never indexed, so they need their whole documents
+            payload = []
+            for instance in missing:
+                payload.extend(get_index_actions(instance))
+            for start in range(0, len(payload), chunk_size * 2):
+                chunk = payload[start:start + chunk_size * 2]
+                check_bulk_response(es.bulk(body=chunk, refresh=refresh))
+        caching.invalidate_models(models)
+        if entries:
+            hashes.record(entries)
+        if settings.ELASTIMORPHIC_PARTIAL_UPDATES:
+            for instance in instances:
+                instance.reset_indexed_state()
+
+
+def get_on_commit(using):
+    """Returns a function registering a callback to run when the current transaction commits,
+    or None if this version of Django (and django-transaction-hooks) can't do that.
+
+    Raises ImproperlyConfigured in that case if ELASTIMORPHIC_INDEX_ON_COMMIT is enabled, rather
+    than indexing before the transaction commits."""
+    if hasattr(transaction, "on_commit"):
+        return lambda func: transaction.on_commit(func, using=using)
+    connection = connections[using]
+    if hasattr(connection, "on_commit"):
+        return connection.on_commit
+    if settings.ELASTIMORPHIC_INDEX_ON_COMMIT:
+        raise ImproperlyConfigured(
+            "ELASTIMORPHIC_INDEX_ON_COMMIT needs Django 1.9+, or a database backend from "
+            "django-transaction-hooks.")
+    return None
+
+
+def run_on_commit(using, func):
+    """Calls `func` once the current transaction on a database commits, or right away if there
+    isn't one (or this version of Django can't tell when it commits)."""
+    on_commit = get_on_commit(using) if connections[using].in_atomic_block else None
+    if on_commit is None:
+        func()
+    else:
+        on_commit(func)
+
+
+class IndexingBuffer(threading.local):
+    """Decides whether an instance should be indexed right away, or later in bulk.
+
+    Instances are buffered while a :func:`batch` is active, or, with ELASTIMORPHIC_INDEX_ON_COMMIT
+    or ELASTIMORPHIC_SKIP_UNCHANGED enabled, while a database transaction is open. Transaction
+    batches are only sent once the transaction commits, and are dropped if it's rolled back.
+
+    The hashes kept by ELASTIMORPHIC_SKIP_UNCHANGED are written to the database, so documents
+    sent before a transaction commits would leave hashes that are rolled back with it, while
+    elasticsearch keeps the documents. Without an on_commit hook (see :func:`get_on_commit`),
+    that can still happen, and the documents are only corrected when their objects change."""
+
+    def __init__(self):
+        self.batches = []
+        self.pending = {}
+
+    def get_commit_batch(self, instance):
+        using = router.db_for_write(instance.__class__, instance=instance)
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            return None
+        on_commit = get_on_commit(using)
+        if on_commit is None:
+            return None
+
+        batch = self.pending.get(using)
+        callbacks = [func for sids, func in getattr(connection, "run_on_commit", [])]
+        if batch is None or batch.callback not in callbacks:
+            # a new transaction, or the last one was rolled back and took our callback with it
+            batch = IndexingBatch()
+            batch.callback = lambda: self.commit(using, batch)
+            self.pending[using] = batch
+            on_commit(batch.callback)
+        return batch
+
+    def commit(self, using, batch):
+        if self.pending.get(using) is batch:
+            del self.pending[using]
+        batch.flush()
+
+    def in_savepoint(self, instance):
+        """Returns whether the instance's database is inside a savepoint, which could still be
+        rolled back without the rest of the transaction."""
+        connection = connections[router.db_for_write(instance.__class__, instance=instance)]
+        return any(sid is not None for sid in connection.savepoint_ids)
+
+    def get_batch(self, instance):
+        if self.batches:
+            return self.batches[-1]
+        if settings.ELASTIMORPHIC_INDEX_ON_COMMIT or settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+            return self.get_commit_batch(instance)
+        return None
+
+    def add(self, instance, refresh=False, savepoint=False):
+        """Buffers an instance to be indexed later.
+
+        Returns False if the instance should be indexed immediately instead."""
+        batch = self.get_batch(instance)
+        if batch is None:
+            return False
+        batch.add(instance, refresh=refresh, savepoint=savepoint or self.in_savepoint(instance))
+        return True
+
+    def delete(self, instance, model, pk, refresh=False, savepoint=False):
+        """Buffers the removal of a deleted instance's document.
+
+        Returns False if it should be removed immediately instead."""
+        batch = self.get_batch(instance)
+        if batch is None:
+            return False
+        batch.delete(instance, model, pk, refresh=refresh, savepoint=savepoint or self.in_savepoint(instance))
+        return True
+
+
+indexing_buffer = IndexingBuffer()
+
+
+@contextmanager
+def batch():
+    """Buffers all indexing done inside the block, and sends it as bulk requests at the end.
+
+    If the block raises an exception, nothing from it is indexed. Nested blocks are merged into
+    the enclosing one, and with ELASTIMORPHIC_INDEX_ON_COMMIT, a block inside a transaction is
+    only sent once the transaction commits. For example::
+
+        with batch():
+            for article in articles:
+                article.save()
+    """
+    current = IndexingBatch()
+    indexing_buffer.batches.append(current)
+    try:
+        yield current
+    except Exception:
+        current.clear()
+        raise
+    finally:
+        indexing_buffer.batches.pop()
+
+    remaining = IndexingBatch()
+    for (model, pk), instance in current.deleted.items():
+        savepoint = (model, pk) in current.savepointed
+        if not indexing_buffer.delete(instance, model, pk, refresh=current.refresh, savepoint=savepoint):
+            remaining.delete(instance, model, pk, refresh=current.refresh, savepoint=savepoint)
+    for key, instance in current.instances.items():
+        savepoint = key in current.savepointed
+        if not indexing_buffer.add(instance, refresh=current.refresh, savepoint=savepoint):
+            remaining.add(instance, refresh=current.refresh, savepoint=savepoint)
+    remaining.flush()
@@ -1,93 +1,213 @@
-import json
-import requests
+import datetime
+import multiprocessing
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
-from django.db import models
-from elasticutils import get_es
-# from pyelasticsearch.client import JsonEncoder
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
-from elastimorphic import PolymorphicIndexable
-from elastimorphic.conf import settings
+from elastimorphic import caching
+from elastimorphic.bulk import (
+    STAGES, Checkpoint, close_connections, get_high_water_mark, get_models_to_index, get_pk_ranges,
+    index_range, init_worker
+)
+
+
+def parse_since(value):
+    """Returns the datetime for a `--since` timestamp (or date)."""
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError("--since takes a timestamp, a date, or \"checkpoint\".")
+        since = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ and timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.get_default_timezone())
+    return since
 
 
 class Command(BaseCommand):
     help = "Bulk indexes all PolymorphicIndexable instances."
-    args = "<?index_suffix>"
+    args = "<?app_label app_label ...>"
     option_list = BaseCommand.option_list + (
         make_option("--chunk",
             type=int,
             dest="chunk",
-            default=250,
-            help="The chunk size to index with"),
+            default=None,
+            help="The largest number of documents to send in one bulk request "
+                 "(ELASTIMORPHIC_BULK_CHUNK_SIZE by default). Smaller chunks are used while the "
+                 "cluster is slow or rejecting documents."),
+        make_option("--max-bytes",
+            type=int,
+            dest="max_bytes",
+            default=None,
+            help="The largest size of one bulk request, in bytes."),
+        make_option("--senders",
+            type=int,
+            dest="senders",
+            default=2,
+            help="Number of threads sending bulk requests from each process, while the next "
+                 "chunks are read and serialized. 0 does everything in turn."),
+        make_option("--only-changed",
+            action="store_true",
+            dest="only_changed",
+            default=False,
+            help="Skip documents which haven't changed since they were last sent to this index."),
         make_option("--index-suffix",
             type=str,
             dest="index_suffix",
             default="",
             help="Suffix for ES index."),
+        make_option("--workers",
+            type=int,
+            dest="workers",
+            default=1,
+            help="Number of processes to index with. Each model's primary keys are split into "
+                 "ranges, which are indexed in parallel."),
+        make_option("--resume",
+            action="store_true",
+            dest="resume",
+            default=False,
+            help="Continue from where the last run for this index suffix stopped."),
+        make_option("--since",
+            type=str,
+            dest="since",
+            default=None,
+            help="Only index objects modified since this timestamp, or since the last run for "
+                 "this index suffix with \"checkpoint\". This needs a last-modified field "
+                 "(see ELASTIMORPHIC_LAST_MODIFIED_FIELD)."),
+        make_option("--from-pk",
+            type=int,
+            dest="from_pk",
+            default=None,
+            help="Only index objects with a primary key of at least this."),
+        make_option("--to-pk",
+            type=int,
+            dest="to_pk",
+            default=None,
+            help="Only index objects with a primary key of at most this."),
     )
 
     def handle(self, *args, **options):
-        self.es = get_es(urls=settings.ES_URLS)
-
         chunk_size = options.get("chunk")
         index_suffix = options.get("index_suffix")
+        workers = options.get("workers") or 1
+        window = (options.get("from_pk"), options.get("to_pk"))
+        since = options.get("since")
+        if since and since != "checkpoint":
+            since = parse_since(since)
 
         if index_suffix:
             index_suffix = "_" + index_suffix
 
-        all_models_to_index = set()
-        if len(args):
-            for app_name in args:
-                for model in models.get_models(models.get_app(app_name)):
-                    if issubclass(model, PolymorphicIndexable):
-                        all_models_to_index.add(model)
-        else:
-            for app in models.get_apps():
-                for model in models.get_models(app):
-                    if issubclass(model, PolymorphicIndexable):
-                        all_models_to_index.add(model)
-
-        # remove redundant subclasses since the instance_of query will select them
-        models_to_index = set()
-        for model_i in all_models_to_index:
-            should_add = True
-            for model_j in all_models_to_index:
-                if model_i != model_j and issubclass(model_i, model_j):
-                    should_add = False
-                    break
-            if should_add:
-                models_to_index.add(model_i)
-
+        models_to_index = get_models_to_index(args)
         self.stdout.write(u"Indexing models: %s" % ', '.join([m.__name__ for m in models_to_index]))
 
-        num_processed = 0
-        payload = []
+        # progress is recorded after every chunk, so that a failed run can be resumed
+        self.checkpoint = Checkpoint(index_suffix)
+        indexer_kwargs = dict(
+            chunk_size=chunk_size, index_suffix=index_suffix, max_bytes=options.get("max_bytes"),
+            senders=options.get("senders"), only_changed=options.get("only_changed"))
+        tasks = []
+        # the high-water marks are read before indexing, so that later changes aren't missed
+        watermarks = {}
         for model in models_to_index:
-            for instance in model.objects.instance_of(model).order_by("id").iterator():
-                meta = {
-                    "index": {
-                        "_index": instance.get_index_name() + index_suffix,
-                        "_type": instance.get_mapping_type_name(),
-                        "_id": instance.pk
-                    }
-                }
-                payload.append(meta)
-                doc = instance.extract_document()
-                payload.append(doc)
-                if len(payload) / 2 == chunk_size:
-                    response = self.es.bulk(body=payload)
-                    good_items = [item for item in response["items"] if item["index"]["status"] <= 299]
-                    if len(good_items) != len(payload) // 2:
-                        self.stdout.write("Bulk indexing error! Item count mismatch.")
-                        bad_items = [item for item in response["items"] if item["index"]["status"] > 201]
-                        self.stdout.write("These were rejected: %s" % str(bad_items))
-                        return "Bulk indexing failed."
-                    num_processed += (len(payload) / 2)
-                    self.stdout.write("Indexed %d items" % num_processed)
-                    payload = []
-
-        if payload:
-            response = self.es.bulk(body=payload)
-            num_processed += (len(payload) / 2)
-            self.stdout.write("Indexed %d items" % num_processed)
+            model_since = None
+            if model.get_last_modified_field() is None:
+                if since:
+                    self.stdout.write(u"%s has no last-modified field, so all of it is indexed" % model.__name__)
+            else:
+                recorded = self.checkpoint.get_watermark(model)
+                model_since = recorded if since == "checkpoint" else since
+                # only a run covering everything since the recorded mark may move it
+                if model_since is None or (recorded is not None and model_since <= recorded):
+                    watermarks[model] = get_high_water_mark(model)
+
+            pending = None
+            if options.get("resume"):
+                pending = self.checkpoint.get_pending(model)
+            if pending is None:
+                if workers > 1:
+                    # several ranges per worker, so that a dense range doesn't leave the others idle
+                    pk_ranges = get_pk_ranges(model, workers * 4, window)
+                else:
+                    pk_ranges = [window]
+                self.checkpoint.start(model, pk_ranges)
+                pending = [(pk_range, None) for pk_range in pk_ranges]
+            for pk_range, after in pending:
+                tasks.append((len(tasks), model, pk_range, after, model_since, indexer_kwargs))
+
+        self.tasks = tasks
+        self.counts = {}
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        if workers > 1:
+            error = self.index_in_parallel(tasks, workers)
+        else:
+            error = self.index(tasks)
+        # even a failed run may have written some documents
+        caching.invalidate_models(models_to_index)
+        # the stages overlap, so these add up to more than the time taken
+        self.stdout.write("Time spent: %s" % ", ".join(
+            "%s %.1fs" % (stage, self.timings[stage]) for stage in STAGES))
+        if error:
+            self.stderr.write("Bulk indexing error! %s" % error)
+            raise CommandError("Bulk indexing failed.")
+        for model, watermark in watermarks.items():
+            # a run over part of the primary keys doesn't bring the whole model up to date
+            if watermark is not None and window == (None, None):
+                self.checkpoint.set_watermark(model, watermark)
+
+    def report(self, task_id, count, last_pk):
+        task_id, model, pk_range = self.tasks[task_id][:3]
+        self.counts[task_id] = count
+        self.checkpoint.update(model, pk_range, last_pk=last_pk)
+        self.stdout.write("Indexed %d items" % sum(self.counts.values()))
+
+    def finish(self, task_id, timings):
+        for stage, seconds in timings.items():
+            self.timings[stage] += seconds
+        task_id, model, pk_range = self.tasks[task_id][:3]
+        self.checkpoint.update(model, pk_range, done=True)
+
+    def index(self, tasks):
+        for task in tasks:
+            task_id = task[0]
+
+            def progress(count, last_pk):
+                self.report(task_id, count, last_pk)
+
+            task_id, count, error, timings = index_range(task, progress=progress)
+            if error:
+                return error
+            self.finish(task_id, timings)
+
+    def index_in_parallel(self, tasks, workers):
+        progress_queue = multiprocessing.Queue()
+
+        # the workers open their own database connections
+        close_connections()
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(progress_queue,))
+        try:
+            results = pool.imap_unordered(index_range, tasks)
+            remaining = len(tasks)
+            while remaining:
+                self.read_progress(progress_queue)
+                try:
+                    task_id, count, error, timings = results.next(timeout=0.1)
+                except multiprocessing.TimeoutError:
+                    continue
+                remaining -= 1
+                if error:
+                    pool.terminate()
+                    self.read_progress(progress_queue)
+                    return error
+                self.finish(task_id, timings)
+            pool.close()
+        finally:
+            pool.join()
+        self.read_progress(progress_queue)
+
+    def read_progress(self, progress_queue):
+        while not progress_queue.empty():
+            self.report(*progress_queue.get())
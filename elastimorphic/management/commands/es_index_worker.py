@@ -0,0 +1,105 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from elastimorphic import caching, hashes
+from elastimorphic.conf import settings
+from elastimorphic.connection import get_es
+from elastimorphic.indexing import check_bulk_response
+from elastimorphic.queues import build_payload, get_index_queue
+
+
+class Command(BaseCommand):
+    help = "Indexes the objects queued when ELASTIMORPHIC_INDEX_QUEUE is set."
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size",
+            type=int,
+            dest="batch_size",
+            default=None,
+            help="The number of queued items sent in each bulk request"),
+        make_option("--concurrency",
+            type=int,
+            dest="concurrency",
+            default=1,
+            help="The number of bulk requests sent at the same time"),
+        make_option("--interval",
+            type=float,
+            dest="interval",
+            default=1.0,
+            help="Seconds to wait when the queue is empty, or after an error"),
+        make_option("--once",
+            action="store_true",
+            dest="once",
+            default=False,
+            help="Exit once the queue is empty, instead of waiting for more work"),
+    )
+
+    def handle(self, *args, **options):
+        self.queue = get_index_queue()
+        if self.queue is None:
+            raise CommandError("ELASTIMORPHIC_INDEX_QUEUE is not set.")
+        self.es = get_es()
+
+        batch_size = options.get("batch_size") or settings.ELASTIMORPHIC_BULK_CHUNK_SIZE
+        concurrency = max(options.get("concurrency") or 1, 1)
+        interval = options.get("interval")
+        once = options.get("once")
+
+        pool = ThreadPool(concurrency)
+        num_processed = 0
+        try:
+            while True:
+                # like a request, each iteration gets a fresh connection if the old one is stale
+                close_old_connections()
+                items = self.queue.get(batch_size * concurrency)
+                if not items:
+                    if once:
+                        break
+                    time.sleep(interval)
+                    continue
+
+                batches = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+                # objects are loaded here, so that only this thread talks to the database
+                payloads = [build_payload(batch) for batch in batches]
+                entries = [None] * len(payloads)
+                if settings.ELASTIMORPHIC_SKIP_UNCHANGED:
+                    filtered = [hashes.filter_unchanged(payload) for payload in payloads]
+                    payloads = [payload for payload, changed in filtered]
+                    entries = [changed for payload, changed in filtered]
+                errors = pool.map(self.send, payloads)
+
+                failed = False
+                for batch, error, changed in zip(batches, errors, entries):
+                    if error is None:
+                        if changed:
+                            hashes.record(changed)
+                        caching.invalidate_models(set(item.model for item in batch))
+                        self.queue.ack(batch)
+                        num_processed += len(batch)
+                    else:
+                        failed = True
+                        self.queue.release(batch)
+                        self.stderr.write("Bulk indexing error! %s" % error)
+                self.stdout.write("Indexed %d items" % num_processed)
+
+                if failed:
+                    if once:
+                        return "Bulk indexing failed."
+                    # the failed items were left in the queue, to be tried again later
+                    time.sleep(interval)
+        finally:
+            pool.close()
+            pool.join()
+
+    def send(self, payload):
+        """Sends a bulk payload, returning the error if it failed."""
+        if not payload:
+            return None
+        try:
+            check_bulk_response(self.es.bulk(body=payload))
+        except Exception as e:
+            return e
+        return None
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
-from elasticutils.contrib.django import get_es
 
+from elastimorphic import caching, hashes
+from elastimorphic.connection import get_es
 from elastimorphic.models import polymorphic_indexable_registry
 
 
@@ -40,3 +41,7 @@ class Command(BaseCommand):
                 }
             })
         es.indices.update_aliases(body=dict(actions=alias_actions))
+        # the hashes recorded through the aliases were for the indexes they used to point at
+        hashes.forget(indexes.keys())
+        # and the search responses cached for them are out of date
+        caching.invalidate(indexes.keys())
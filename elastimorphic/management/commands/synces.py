@@ -3,9 +3,10 @@ from optparse import make_option
 from django.core.management.base import BaseCommand
 
 import elasticsearch
-from elasticutils import get_es
 
+from elastimorphic import hashes
 from elastimorphic.conf import settings
+from elastimorphic.connection import get_es
 from elastimorphic.models import polymorphic_indexable_registry
 
 
@@ -28,7 +29,7 @@ class Command(BaseCommand):
     )
 
     def handle(self, *args, **options):
-        es = get_es(urls=settings.ES_URLS)
+        es = get_es()
         index_alias_map = {}
         if args:
             index_suffix = args[0]
@@ -57,7 +58,15 @@ class Command(BaseCommand):
 
         for index, mappings in indexes.items():
             if options.get("drop_existing_indexes", False) and index_suffix:
+                dropped = [index]
+                try:
+                    dropped.extend(es.indices.get_aliases(index=index).get(index, {}).get("aliases", {}))
+                except elasticsearch.NotFoundError:
+                    pass
                 es.indices.delete(index=index, ignore=[404])
+                # the hashes recorded through the index (or its aliases) are for documents it no
+                # longer has, and would keep bulk_index --only-changed from sending them again
+                hashes.forget(dropped)
             try:
                 es.indices.create(index=index, body=dict(settings=settings.ES_SETTINGS))
             except elasticsearch.RequestError:
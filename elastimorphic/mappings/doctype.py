@@ -1,3 +1,5 @@
+import datetime
+
 from .fields import *  # noqa
 
 
@@ -5,7 +7,15 @@ class DeclarativeMappingMeta(type):
  
     def __new__(cls, name, bases, attrs):
         fields = [(name_, attrs.pop(name_)) for name_, column in attrs.items() if hasattr(column, "get_definition")]
-        attrs['fields'] = fields
+        # inherit the fields declared on base Mappings, unless they're redeclared here
+        declared = set(name_ for name_, column in fields)
+        inherited = []
+        for base in bases:
+            for name_, column in getattr(base, "fields", ()):
+                if name_ not in declared:
+                    declared.add(name_)
+                    inherited.append((name_, column))
+        attrs['fields'] = inherited + fields
         return super(DeclarativeMappingMeta, cls).__new__(cls, name, bases, attrs)
 
 
@@ -28,12 +38,32 @@ class DocumentType(SearchField):
         definition.update(self.get_mapping())
         return definition
 
+    def extract(self, obj):
+        """Returns the document for an object, with a function compiled for these fields."""
+        if "_extractor" not in self.__class__.__dict__:
+            self.__class__._extractor = staticmethod(compile_extractor(self.fields))
+        return self._extractor(obj)
+
+    def extract_fields(self, obj, names):
+        """Returns part of the document for an object, with just the named fields."""
+        names = tuple(sorted(names))
+        extractors = self.__class__.__dict__.get("_partial_extractors")
+        if extractors is None:
+            extractors = self.__class__._partial_extractors = {}
+        extractor = extractors.get(names)
+        if extractor is None:
+            fields = [(name, field) for name, field in self.fields if name in names]
+            extractor = extractors[names] = compile_extractor(fields)
+        return extractor(obj)
+
     def to_es(self, value):
-        document = {}
-        for name, field in self.fields:
-            value = getattr(self, name, None)
-            document[name] = field.to_es(value)
-        return document
+        """Returns the nested document for a related object, or a list of them for a
+        many-valued relation (a related manager)."""
+        if value is None:
+            return None
+        if callable(getattr(value, "all", None)):
+            return [self.extract(obj) for obj in value.all()]
+        return self.extract(value)
 
     def to_python(self, value):
         return None
@@ -50,6 +80,71 @@ SIMPLE_FIELD_MAPPINGS = {
 }
 
 
+# converters inlined by compile_extractor(), for fields of exactly these classes
+INLINE_CONVERTERS = {
+    SearchField: "{0}",
+    StringField: "None if {0} is None else unicode({0})",
+    IntegerField: "None if {0} is None else int({0})",
+    FloatField: "None if {0} is None else float({0})",
+    DateField: "{0}.isoformat() if isinstance({0}, _dates) else {0}",
+}
+
+
+def compile_extractor(fields):
+    """Returns a function building the document for an object, from (name, field) pairs.
+
+    The function's source is generated, so that each attribute is read and the simple field
+    types are converted inline, without looping or calling `to_es` for every field."""
+    namespace = {"_dates": (datetime.date, datetime.datetime)}
+    lines = ["def extract(obj):"]
+    items = []
+    for i, (name, field) in enumerate(fields):
+        value = "value%d" % i
+        lines.append("    %s = getattr(obj, %r, None)" % (value, field.source or name))
+        converter = INLINE_CONVERTERS.get(type(field))
+        if converter is None:
+            namespace["to_es%d" % i] = field.to_es
+            converter = "to_es%d({0})" % i
+        items.append("%r: %s" % (name, converter.format(value)))
+    lines.append("    return {%s}" % ", ".join(items))
+    exec("\n".join(lines), namespace)
+    return namespace["extract"]
+
+
+def extract_columns(fields, rows):
+    """Returns the documents for rows of values, with one value for each (name, field) pair.
+
+    Each column is converted with a single `to_es_many` call, rather than value by value."""
+    names = [name for name, field in fields]
+    columns = [field.to_es_many(column) for (name, field), column in zip(fields, zip(*rows))]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def compile_doctype(model):
+    """Returns the DocumentType instance describing a model's documents.
+
+    The model's `Mapping` (if it has one) is combined with a field for every other model field
+    that has a simple equivalent, leaving out the names in the Mapping's `exclude` (or
+    `Meta.exclude`). This builds a subclass with its fields frozen in a tuple, so the declared
+    Mapping is never changed."""
+    mapping = getattr(model, "Mapping", DocumentType)
+    fields = list(mapping.fields)
+
+    exclude = set(name for name, field in fields)
+    exclude.update(getattr(mapping, "exclude", ()))
+    exclude.update(getattr(getattr(mapping, "Meta", None), "exclude", ()))
+    for field in model._meta.fields:
+        if field.name in exclude or field.get_attname() in exclude:
+            continue
+        field_tuple = search_field_factory(field)
+        if field_tuple:
+            fields.append(field_tuple)
+
+    doctype_class = type("{}_Mapping".format(model.__name__), (mapping,), {})
+    doctype_class.fields = tuple(fields)
+    return doctype_class()
+
+
 def search_field_factory(field):
     """Returns a tuple (name, field) representing the Django model field as a SearchField
     """
@@ -58,5 +153,10 @@ def search_field_factory(field):
     klass = SIMPLE_FIELD_MAPPINGS.get(internal_type)
 
     if klass:
-        return (field.get_attname(), klass())
+        search_field = klass()
+        if field.name == "polymorphic_ctype":
+            # PolymorphicIndexable documents have always stored the ctype id under this name
+            search_field.source = field.get_attname()
+            return (field.name, search_field)
+        return (field.get_attname(), search_field)
     return None
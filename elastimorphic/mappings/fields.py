@@ -7,9 +7,12 @@ class SearchField(object):
     
     field_type = None
     attrs = []
+    # the attribute read from objects, if it isn't the document field's name
+    source = None
 
     def __init__(self, *args, **kwargs):
         # Set all kwargs on self for later access.
+        self.attrs = list(self.attrs)
         for attr in kwargs.keys():
             self.attrs.append(attr)
             setattr(self, attr, kwargs.pop(attr, None))
@@ -17,6 +20,10 @@ class SearchField(object):
     def to_es(self, value):
         return value
 
+    def to_es_many(self, values):
+        """Converts a whole column of values at once."""
+        return [self.to_es(value) for value in values]
+
     def to_python(self, value):
         return value
 
@@ -38,6 +45,9 @@ class StringField(SearchField):
             return None
         return unicode(value)
 
+    def to_es_many(self, values):
+        return [None if value is None else unicode(value) for value in values]
+
     def to_python(self, value):
         if value is None:
             return None
@@ -52,6 +62,9 @@ class IntegerField(SearchField):
             return None
         return int(value)
 
+    def to_es_many(self, values):
+        return [None if value is None else int(value) for value in values]
+
     def to_python(self, value):
         if value is None:
             return None
@@ -66,6 +79,9 @@ class FloatField(SearchField):
             return None
         return float(value)
 
+    def to_es_many(self, values):
+        return [None if value is None else float(value) for value in values]
+
     def to_python(self, value):
         if value is None:
             return None
@@ -80,6 +96,10 @@ class DateField(SearchField):
             return value.isoformat()
         return value
 
+    def to_es_many(self, values):
+        dates = (datetime.date, datetime.datetime)
+        return [value.isoformat() if isinstance(value, dates) else value for value in values]
+
     def to_python(self, value):
         if value is None:
             return None
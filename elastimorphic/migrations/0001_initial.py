@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkIndexCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('index_suffix', models.CharField(max_length=255, blank=True)),
+                ('model', models.CharField(max_length=255)),
+                ('range_start', models.BigIntegerField(null=True)),
+                ('range_end', models.BigIntegerField(null=True)),
+                ('last_pk', models.BigIntegerField(null=True)),
+                ('done', models.BooleanField(default=False)),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='BulkIndexWatermark',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('index_suffix', models.CharField(max_length=255, blank=True)),
+                ('model', models.CharField(max_length=255)),
+                ('last_modified', models.DateTimeField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='IndexedDocument',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('index', models.CharField(max_length=255)),
+                ('doc_type', models.CharField(max_length=255)),
+                ('object_id', models.CharField(max_length=255)),
+                ('hash', models.CharField(max_length=40)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='IndexQueueItem',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('op', models.CharField(default=b'index', max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('claim', models.CharField(db_index=True, max_length=32, blank=True)),
+                ('claimed_until', models.DateTimeField(null=True, db_index=True)),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='indexeddocument',
+            unique_together=set([('index', 'doc_type', 'object_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='bulkindexwatermark',
+            unique_together=set([('index_suffix', 'model')]),
+        ),
+    ]
@@ -1,38 +1,59 @@
-import django
-from django.db.models.signals import class_prepared
+from django.db import models
 
+from .registry import PolymorphicIndexableRegistry, polymorphic_indexable_registry  # noqa
 
-class PolymorphicIndexableRegistry(object):
-    """Contains information about all PolymorphicIndexables in the project."""
-    def __init__(self):
-        self.all_models = {}
-        self.families = {}
 
-    def register(self, klass):
-        """Adds a new PolymorphicIndexable to the registry."""
-        self.all_models[klass.get_mapping_type_name()] = klass
-        base_class = klass.get_base_class()
-        if not base_class in self.families:
-            self.families[base_class] = {}
-        self.families[base_class][klass.get_mapping_type_name()] = klass
+class IndexQueueItem(models.Model):
+    """An indexing operation waiting for the `es_index_worker` command, used by
+    :class:`elastimorphic.queues.DatabaseQueue`."""
 
-    def get_doctypes(self, klass):
-        """Returns all the mapping types for a given class."""
-        base = klass.get_base_class()
-        return self.families[base]
+    content_type = models.ForeignKey("contenttypes.ContentType")
+    object_id = models.PositiveIntegerField()
+    op = models.CharField(max_length=16, default="index")
+    created = models.DateTimeField(auto_now_add=True)
+    # set while a worker is processing the item
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, db_index=True)
 
+    class Meta:
+        ordering = ("id",)
 
-polymorphic_indexable_registry = PolymorphicIndexableRegistry()
 
-if django.VERSION < (1, 7):
-    def register_polymorphicindexables(sender=None, **kwargs):
-        from .base import PolymorphicIndexable
+class BulkIndexCheckpoint(models.Model):
+    """How far the `bulk_index` command got through one range of a model's primary keys, so
+    that an interrupted run can be resumed."""
 
-        if not issubclass(sender, PolymorphicIndexable):
-            return
+    index_suffix = models.CharField(max_length=255, blank=True)
+    model = models.CharField(max_length=255)
+    range_start = models.BigIntegerField(null=True)
+    range_end = models.BigIntegerField(null=True)
+    last_pk = models.BigIntegerField(null=True)
+    done = models.BooleanField(default=False)
 
-        polymorphic_indexable_registry.register(sender)
+    class Meta:
+        ordering = ("id",)
 
 
-    class_prepared.connect(
-        register_polymorphicindexables, dispatch_uid="polymorphicindexable_class_prepared")
+class BulkIndexWatermark(models.Model):
+    """The newest last-modified time among a model's objects when the `bulk_index` command last
+    indexed them, so that `--since checkpoint` can catch up from there."""
+
+    index_suffix = models.CharField(max_length=255, blank=True)
+    model = models.CharField(max_length=255)
+    last_modified = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("index_suffix", "model")
+
+
+class IndexedDocument(models.Model):
+    """A hash of the last document sent to an index for an object, used to skip re-sending
+    documents which haven't changed when ELASTIMORPHIC_SKIP_UNCHANGED is enabled."""
+
+    index = models.CharField(max_length=255)
+    doc_type = models.CharField(max_length=255)
+    object_id = models.CharField(max_length=255)
+    hash = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = ("index", "doc_type", "object_id")
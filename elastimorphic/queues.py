@@ -0,0 +1,198 @@
+import datetime
+import itertools
+import threading
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+
+from django.db.models import Q
+from django.utils import timezone
+
+try:
+    from django.utils.module_loading import import_string
+except ImportError:  # Django < 1.7
+    from django.utils.module_loading import import_by_path as import_string
+
+from .conf import settings
+from .hydration import get_non_polymorphic_queryset, prefetch_related_documents
+from .indexing import get_delete_action, get_index_actions
+from .registry import polymorphic_indexable_registry
+
+
+QueuedItem = namedtuple("QueuedItem", ["id", "model", "pk", "op"])
+
+
+class BaseQueue(object):
+    """A place for Indexable.index() to leave work for the `es_index_worker` command.
+
+    Subclasses need to implement :func:`put`, :func:`get`, :func:`ack`, :func:`release` and
+    :func:`__len__`. Several workers can share a queue, since each item is only handed to one of
+    them at a time."""
+
+    def put(self, model, pks, op="index"):
+        """Queues an operation for some objects of the given model."""
+        raise NotImplementedError()
+
+    def get(self, limit):
+        """Claims and returns up to `limit` of the oldest unclaimed QueuedItems.
+
+        The items stay in the queue, but aren't returned again until they're released, or
+        ELASTIMORPHIC_INDEX_QUEUE_LEASE seconds pass (in case the worker died)."""
+        raise NotImplementedError()
+
+    def ack(self, items):
+        """Removes items from the queue, once they've been processed."""
+        raise NotImplementedError()
+
+    def release(self, items):
+        """Gives up the claim on items which couldn't be processed, so they're tried again."""
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class LocalQueue(BaseQueue):
+    """A queue which lives in the memory of the current process. Mostly useful for tests."""
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.claimed_until = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def put(self, model, pks, op="index"):
+        with self.lock:
+            for pk in pks:
+                item_id = next(self.ids)
+                self.items[item_id] = QueuedItem(item_id, model, pk, op)
+
+    def get(self, limit):
+        now = time.time()
+        with self.lock:
+            items = [
+                item for item in self.items.values() if self.claimed_until.get(item.id, 0) <= now
+            ][:limit]
+            for item in items:
+                self.claimed_until[item.id] = now + settings.ELASTIMORPHIC_INDEX_QUEUE_LEASE
+            return items
+
+    def ack(self, items):
+        with self.lock:
+            for item in items:
+                self.items.pop(item.id, None)
+                self.claimed_until.pop(item.id, None)
+
+    def release(self, items):
+        with self.lock:
+            for item in items:
+                self.claimed_until.pop(item.id, None)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class DatabaseQueue(BaseQueue):
+    """A queue stored in the IndexQueueItem table.
+
+    Items are written in the same transaction as the objects they refer to, so work from
+    rolled-back transactions is never queued."""
+
+    chunk_size = 500
+
+    def put(self, model, pks, op="index"):
+        from .models import IndexQueueItem
+
+        ctype_id = polymorphic_indexable_registry.get_ctype_id(model)
+        IndexQueueItem.objects.bulk_create([
+            IndexQueueItem(content_type_id=ctype_id, object_id=pk, op=op) for pk in pks
+        ])
+
+    def get(self, limit):
+        from .models import IndexQueueItem
+
+        now = timezone.now()
+        claimable = IndexQueueItem.objects.filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+        ids = list(claimable.values_list("id", flat=True)[:limit])
+        if not ids:
+            return []
+        # the conditions are checked again by the update, so rows another worker claimed in the
+        # meantime are left to it
+        claim = uuid.uuid4().hex
+        claimable.filter(id__in=ids).update(
+            claim=claim,
+            claimed_until=now + datetime.timedelta(seconds=settings.ELASTIMORPHIC_INDEX_QUEUE_LEASE))
+
+        items = []
+        for item in IndexQueueItem.objects.filter(claim=claim):
+            model = polymorphic_indexable_registry.get_ctype_model(item.content_type_id)
+            items.append(QueuedItem(item.id, model, item.object_id, item.op))
+        return items
+
+    def ack(self, items):
+        from .models import IndexQueueItem
+
+        ids = [item.id for item in items]
+        for start in range(0, len(ids), self.chunk_size):
+            IndexQueueItem.objects.filter(id__in=ids[start:start + self.chunk_size]).delete()
+
+    def release(self, items):
+        from .models import IndexQueueItem
+
+        ids = [item.id for item in items]
+        for start in range(0, len(ids), self.chunk_size):
+            IndexQueueItem.objects.filter(id__in=ids[start:start + self.chunk_size]).update(
+                claim="", claimed_until=None)
+
+    def __len__(self):
+        from .models import IndexQueueItem
+
+        return IndexQueueItem.objects.count()
+
+
+_queues = {}
+
+
+def get_index_queue():
+    """Returns the queue backend named by ELASTIMORPHIC_INDEX_QUEUE, or None if queueing is off."""
+    path = settings.ELASTIMORPHIC_INDEX_QUEUE
+    if not path:
+        return None
+    if path not in _queues:
+        _queues[path] = import_string(path)()
+    return _queues[path]
+
+
+def build_payload(items):
+    """Returns the bulk payload for a list of QueuedItems.
+
+    Repeated operations on the same object are collapsed into the last one, and objects are
+    loaded with one query per model. Deletes are added as delete actions, which (unlike the
+    others) have no data line."""
+    latest = OrderedDict()
+    for item in items:
+        key = (item.model, item.pk)
+        latest.pop(key, None)
+        latest[key] = item
+
+    pks_by_model = {}
+    for item in latest.values():
+        if item.op != "delete":
+            pks_by_model.setdefault(item.model, []).append(item.pk)
+    instances = {}
+    for model, pks in pks_by_model.items():
+        instances[model] = get_non_polymorphic_queryset(model).in_bulk(pks)
+        prefetch_related_documents(instances[model].values())
+
+    payload = []
+    for item in latest.values():
+        if item.op == "delete":
+            payload.append(get_delete_action(item.model, item.pk))
+            continue
+        instance = instances[item.model].get(item.pk)
+        if instance is None:
+            # the object was deleted after it was queued
+            continue
+        payload.extend(get_index_actions(instance))
+    return payload
@@ -0,0 +1,158 @@
+import django
+from django.db.models.signals import class_prepared
+
+
+class PolymorphicIndexableRegistry(object):
+    """Contains information about all PolymorphicIndexables in the project.
+
+    Once every model is registered, :func:`freeze` precomputes the answers to the questions
+    asked on every search and save, so that those become dict lookups."""
+    def __init__(self):
+        self.all_models = {}
+        self.families = {}
+        self.mapping_types = {}
+        self.base_classes = {}
+        self.mapping_type_names = {}
+        self.index_names = {}
+        self.ctype_models = {}
+        self.model_ctypes = {}
+        self.ctypes_loaded = False
+
+    def register(self, klass):
+        """Adds a new PolymorphicIndexable to the registry."""
+        # the new class changes the answers for its ancestors, until the next freeze()
+        self.clear_lookups()
+        self.ctypes_loaded = False
+        self.all_models[klass.get_mapping_type_name()] = klass
+        base_class = klass.get_base_class()
+        if not base_class in self.families:
+            self.families[base_class] = {}
+            self.mapping_types[base_class] = self.create_mapping_type(base_class)
+        self.families[base_class][klass.get_mapping_type_name()] = klass
+        self.mapping_types[klass] = self.mapping_types[base_class]
+
+    def create_mapping_type(self, base_class):
+        """Builds the MappingType class used to search a family of PolymorphicIndexables."""
+        from .base import PolymorphicMappingType
+
+        return type(
+            "%sMappingType" % base_class.__name__,
+            (PolymorphicMappingType,),
+            {"base_polymorphic_class": base_class})
+
+    def get_mapping_type(self, klass):
+        """Returns the MappingType for the family a given class belongs to.
+
+        The MappingType is built once per family, so searches don't pay for creating a new class."""
+        try:
+            return self.mapping_types[klass]
+        except KeyError:
+            base_class = klass.get_base_class()
+            if base_class not in self.mapping_types:
+                self.mapping_types[base_class] = self.create_mapping_type(base_class)
+            self.mapping_types[klass] = self.mapping_types[base_class]
+            return self.mapping_types[klass]
+
+    def clear_lookups(self):
+        self.base_classes = {}
+        self.mapping_type_names = {}
+        self.index_names = {}
+
+    def freeze(self, models=()):
+        """Precomputes the base class, the mapping type names (its own and its descendants') and
+        the index name of every registered class, along with the index names of `models`.
+
+        The classmethods of Indexable and PolymorphicIndexable look these up, and work them out
+        as before for classes that aren't here (like the ones Django creates for deferred
+        fields)."""
+        self.clear_lookups()
+        classes = set(self.all_models.values())
+        base_classes = dict((klass, klass.get_base_class()) for klass in classes)
+        mapping_type_names = dict((klass, tuple(klass.get_mapping_type_names())) for klass in classes)
+        index_names = dict((klass, klass.get_index_name()) for klass in classes.union(models))
+        self.base_classes = base_classes
+        self.mapping_type_names = mapping_type_names
+        self.index_names = index_names
+
+    def add_ctype(self, ctype_id, model):
+        self.ctype_models[ctype_id] = model
+        self.model_ctypes[model] = ctype_id
+
+    def load_ctypes(self):
+        """Fills the table between polymorphic_ctype ids and the registered classes, from
+        ContentType's cache (with one query for the ones it doesn't have yet).
+
+        This happens the first time it's needed, since the database can't be used while the
+        app registry is loading."""
+        from django.contrib.contenttypes.models import ContentType
+
+        ctypes = ContentType.objects.get_for_models(*self.all_models.values(), for_concrete_models=False)
+        for model, ctype in ctypes.items():
+            self.add_ctype(ctype.id, model)
+        self.ctypes_loaded = True
+
+    def get_ctype_model(self, ctype_id):
+        """Returns the model class for a polymorphic_ctype id, or None if the content type's
+        model doesn't exist anymore."""
+        if not self.ctypes_loaded:
+            self.load_ctypes()
+        try:
+            return self.ctype_models[ctype_id]
+        except KeyError:
+            from django.contrib.contenttypes.models import ContentType
+
+            # one that isn't registered, like a plain Indexable
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            if model is not None:
+                self.ctype_models[ctype_id] = model
+                self.model_ctypes.setdefault(model, ctype_id)
+            return model
+
+    def get_ctype_id(self, klass):
+        """Returns the polymorphic_ctype id for a model class (the one Django made a deferred
+        class for, in the case of objects loaded with `only()` or `defer()`)."""
+        if not self.ctypes_loaded:
+            self.load_ctypes()
+        try:
+            return self.model_ctypes[klass]
+        except KeyError:
+            from django.contrib.contenttypes.models import ContentType
+
+            if getattr(klass, "_deferred", False):
+                return self.get_ctype_id(klass._meta.proxy_for_model)
+            ctype_id = ContentType.objects.get_for_model(klass, for_concrete_model=False).id
+            self.model_ctypes[klass] = ctype_id
+            self.ctype_models.setdefault(ctype_id, klass)
+            return ctype_id
+
+    def get_mapping_type_model(self, name):
+        """Returns the registered class with a mapping type name, or None."""
+        return self.all_models.get(name)
+
+    def clear_ctypes(self, **kwargs):
+        """Forgets the content types looked up so far, e.g. when they're recreated."""
+        self.ctype_models = {}
+        self.model_ctypes = {}
+        self.ctypes_loaded = False
+
+    def get_doctypes(self, klass):
+        """Returns all the mapping types for a given class."""
+        base = klass.get_base_class()
+        return self.families[base]
+
+
+polymorphic_indexable_registry = PolymorphicIndexableRegistry()
+
+if django.VERSION < (1, 7):
+    def register_polymorphicindexables(sender=None, **kwargs):
+        from .base import PolymorphicIndexable
+
+        # deferred classes (for only() and defer()) are prepared too, but they aren't models
+        if not issubclass(sender, PolymorphicIndexable) or sender._deferred:
+            return
+
+        polymorphic_indexable_registry.register(sender)
+
+
+    class_prepared.connect(
+        register_polymorphicindexables, dispatch_uid="polymorphicindexable_class_prepared")
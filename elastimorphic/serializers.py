@@ -1,16 +1,28 @@
 from django.contrib.contenttypes.models import ContentType
 from rest_framework import serializers
 
+from .registry import polymorphic_indexable_registry
+
 
 class ContentTypeField(serializers.WritableField):
-    """Converts between natural key for native use and integer for non-native."""
+    """Converts between natural key for native use and integer for non-native.
+
+    The natural keys of registered models are their mapping type names, so those are converted
+    without touching the database."""
     def to_native(self, value):
         """Convert to natural key."""
-        content_type = ContentType.objects.get_for_id(value)
-        return "_".join(content_type.natural_key())
+        model = polymorphic_indexable_registry.get_ctype_model(value)
+        if model is None:
+            # a content type whose model is gone
+            content_type = ContentType.objects.get_for_id(value)
+            return "_".join(content_type.natural_key())
+        return "%s_%s" % (model._meta.app_label, model._meta.model_name)
 
     def from_native(self, value):
         """Convert to integer id."""
+        model = polymorphic_indexable_registry.get_mapping_type_model(value)
+        if model is not None and value == "%s_%s" % (model._meta.app_label, model._meta.model_name):
+            return polymorphic_indexable_registry.get_ctype_id(model)
         natural_key = value.split("_")
         content_type = ContentType.objects.get_by_natural_key(*natural_key)
         return content_type.id
@@ -1,8 +1,7 @@
 from django.core.management import call_command
 from django.test import TestCase
-from elasticutils import get_es
 
-from elastimorphic.conf import settings
+from elastimorphic.connection import get_es
 from elastimorphic.models import polymorphic_indexable_registry
 
 
@@ -10,7 +9,7 @@ class BaseIndexableTestCase(TestCase):
     """A TestCase which handles setup and teardown of elasticsearch indexes."""
     def setUp(self):
         self.index_suffix = "vtest"
-        self.es = get_es(urls=settings.ES_URLS)
+        self.es = get_es()
         call_command("synces", self.index_suffix, drop_existing_indexes=True)
         call_command("es_swap_aliases", self.index_suffix)
 
@@ -2,6 +2,8 @@ from django.db import models
 from polymorphic import PolymorphicModel
 
 from elastimorphic import PolymorphicIndexable, SearchManager
+from elastimorphic.mappings import fields
+from elastimorphic.mappings.doctype import DocumentType
 
 
 class SeparateIndexable(PolymorphicIndexable, PolymorphicModel):
@@ -106,3 +108,40 @@ class PolyMixin(PolymorphicIndexable, models.Model):
 
 class MixedIndexable(SeparateIndexable, PolyMixin):
     pass
+
+
+class DeclarativeIndexable(PolymorphicIndexable, PolymorphicModel):
+    title = models.CharField(max_length=255)
+    views = models.IntegerField(default=0)
+    published = models.DateTimeField(null=True, blank=True)
+    body = models.TextField(default="", blank=True)
+    last_modified = models.DateTimeField(auto_now=True, null=True)
+
+    search_objects = SearchManager()
+
+    class Mapping(DocumentType):
+        title = fields.StringField()
+        views = fields.IntegerField()
+        published = fields.DateField()
+
+        class Meta:
+            exclude = ("last_modified",)
+
+    @classmethod
+    def get_last_modified_field(cls):
+        return "last_modified"
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=255)
+
+    class Mapping(DocumentType):
+        name = fields.StringField()
+
+
+class DeclarativeChildIndexable(DeclarativeIndexable):
+    rating = models.FloatField(null=True, blank=True)
+    author = models.ForeignKey(Author, null=True, blank=True)
+
+    class Mapping(DeclarativeIndexable.Mapping):
+        author = Author.Mapping()
@@ -89,6 +89,8 @@ setup(
     packages=get_packages("elastimorphic"),
     package_data=get_package_data(package),
     install_requires=requires,
+    # ELASTIMORPHIC_INDEX_ON_COMMIT needs this before Django 1.9
+    extras_require={"on_commit": ["django-transaction-hooks"]},
     tests_require=["pytest-django", "djangorestframework==2.3.13", "requests"],
     cmdclass={"test": PyTest}
 )
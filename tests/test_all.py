@@ -2,20 +2,37 @@ from __future__ import absolute_import
 
 import copy
 import datetime
+import json
+import unittest
 
+import django
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
+from django.db import connection as db_connection, transaction
+from django.db.models import F
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import six
 
 import elasticsearch
 
 from elasticutils import get_es
 
+from elastimorphic import Indexable, PolymorphicS, background, bulk, caching, connection, hashes, indexing, queues
 from elastimorphic.conf import settings
-from elastimorphic.models import polymorphic_indexable_registry
+from elastimorphic.hydration import get_hit_model, hydrate, prefetch_related_documents
+from elastimorphic.management.commands import bulk_index, es_index_worker, synces
+from elastimorphic.mappings import fields
+from elastimorphic.mappings.doctype import DocumentType, compile_doctype, compile_extractor
+from elastimorphic.models import IndexedDocument, polymorphic_indexable_registry
 
 from elastimorphic.tests.base import BaseIndexableTestCase
 from elastimorphic.tests.testapp.models import (
+    Author,
     ChildIndexable,
+    DeclarativeChildIndexable,
+    DeclarativeIndexable,
     GrandchildIndexable,
     ParentIndexable,
     SeparateIndexable,
@@ -86,6 +103,14 @@ class IndexableTestCase(BaseIndexableTestCase):
 
         self.assertEqual(len(qs[:2]), 2)
 
+    def test_model_results_keep_hit_order(self):
+        qs = ParentIndexable.search_objects.s().order_by("-id").full()
+        self.assertEqual(
+            [obj.__class__ for obj in qs],
+            [GrandchildIndexable, ChildIndexable, ParentIndexable])
+        ids = [obj.id for obj in qs]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
     def test_s_all_respects_slicing(self):
         s = ParentIndexable.search_objects.s()
         num_s = s.count()
@@ -93,6 +118,130 @@ class IndexableTestCase(BaseIndexableTestCase):
         sliced = s[1:2]
         self.assertEqual(len(sliced.all()), 1)
 
+    def test_iterate(self):
+        s = ParentIndexable.search_objects.s()
+        self.assertEqual(len(list(s.iterate(batch_size=1))), 3)
+        self.assertEqual(len(list(s[1:].iterate(batch_size=1))), 2)
+        self.assertEqual(len(list(s[1:2].iterate(batch_size=2))), 1)
+
+    def test_iterate_full(self):
+        s = ParentIndexable.search_objects.s().order_by("id").full()
+        objects = list(s.iterate(batch_size=2))
+        self.assertEqual(
+            [obj.__class__ for obj in objects],
+            [ParentIndexable, ChildIndexable, GrandchildIndexable])
+
+
+class FakeMsearchES(object):
+    """Answers each search of an msearch request with the next of some canned lists of hits."""
+
+    def __init__(self, *hits):
+        self.hits = hits
+        self.requests = []
+
+    def msearch(self, body):
+        self.requests.append(body)
+        return {"responses": [
+            {"hits": {"total": len(hits), "max_score": 1.0, "hits": hits}} for hits in self.hits
+        ]}
+
+
+class HydrationTestCase(TestCase):
+
+    def setUp(self):
+        self.parent = ParentIndexable(foo="Fighters")
+        self.parent.save(index=False)
+        self.child = ChildIndexable(foo="Fighters", bar=69)
+        self.child.save(index=False)
+        self.grandchild = GrandchildIndexable(foo="Fighters", bar=69, baz=datetime.date.today())
+        self.grandchild.save(index=False)
+
+    def get_hit(self, obj):
+        return {
+            "_id": str(obj.pk),
+            "fields": {"polymorphic_ctype": [obj.polymorphic_ctype_id]}
+        }
+
+    def test_hydrate_keeps_hit_order(self):
+        hits = [self.get_hit(obj) for obj in (self.child, self.grandchild, self.parent)]
+        objects = hydrate(hits, ParentIndexable)
+        self.assertEqual(objects, [self.child, self.grandchild, self.parent])
+        self.assertEqual(
+            [obj.__class__ for obj in objects],
+            [ChildIndexable, GrandchildIndexable, ParentIndexable])
+
+    def test_hydrate_one_query_per_class(self):
+        for klass in (ParentIndexable, ChildIndexable, GrandchildIndexable):
+            ContentType.objects.get_for_model(klass, for_concrete_model=False)
+        other_child = ChildIndexable(foo="Foo", bar=1)
+        other_child.save(index=False)
+        objs = (self.child, self.grandchild, other_child, self.parent)
+        hits = [self.get_hit(obj) for obj in objs]
+        with self.assertNumQueries(3):
+            objects = hydrate(hits, ParentIndexable)
+        self.assertEqual(objects, list(objs))
+
+    def test_hydrate_without_ctype(self):
+        hits = [{"_id": str(self.grandchild.pk)}, {"_id": str(self.parent.pk)}]
+        objects = hydrate(hits, ParentIndexable)
+        self.assertEqual(objects, [self.grandchild, self.parent])
+        self.assertIsInstance(objects[0], GrandchildIndexable)
+
+    def test_hit_model(self):
+        self.assertEqual(get_hit_model({"_type": "testapp_grandchildindexable"}), GrandchildIndexable)
+        self.assertEqual(get_hit_model(self.get_hit(self.child)), ChildIndexable)
+        self.assertIsNone(get_hit_model({"_id": "1"}))
+
+    def test_hydrate_drops_missing_objects(self):
+        hits = [self.get_hit(self.child), {"_id": "9999", "fields": {"polymorphic_ctype": [self.child.polymorphic_ctype_id]}}]
+        self.assertEqual(hydrate(hits, ParentIndexable), [self.child])
+
+    def get_search(self, es, full=True):
+        s = ParentIndexable.search_objects.s().instance_of(ChildIndexable)
+        if full:
+            s = s.full()
+        s.get_es = lambda: es
+        return s
+
+    def test_msearch(self):
+        es = FakeMsearchES(
+            [self.get_hit(self.child), self.get_hit(self.grandchild)],
+            [self.get_hit(self.parent)])
+        first = self.get_search(es)
+        second = self.get_search(es, full=False)
+        results = PolymorphicS.msearch([first, second])
+
+        self.assertEqual(len(es.requests), 1)
+        body = es.requests[0]
+        self.assertEqual(len(body), 4)
+        self.assertEqual(body[0]["index"], ParentIndexable.get_index_name())
+        self.assertEqual(body[0]["type"].split(","), ChildIndexable.get_mapping_type_names())
+        self.assertEqual(body[1], first.build_search())
+
+        self.assertEqual(list(results[0]), [self.child, self.grandchild])
+        self.assertEqual([result.es_meta.id for result in results[1]], [str(self.parent.pk)])
+        with self.assertNumQueries(0):
+            self.assertEqual(list(first), [self.child, self.grandchild])
+            self.assertEqual(first.count(), 2)
+        self.assertEqual(len(es.requests), 1)
+
+    def test_msearch_hydrates_together(self):
+        for klass in (ParentIndexable, ChildIndexable, GrandchildIndexable):
+            ContentType.objects.get_for_model(klass, for_concrete_model=False)
+        es = FakeMsearchES(
+            [self.get_hit(self.child), self.get_hit(self.parent)],
+            [self.get_hit(self.grandchild), self.get_hit(self.child)])
+        with self.assertNumQueries(3):
+            first, second = PolymorphicS.msearch([self.get_search(es), self.get_search(es)])
+        self.assertEqual(list(first), [self.child, self.parent])
+        self.assertEqual(list(second), [self.grandchild, self.child])
+
+    def test_msearch_error(self):
+        es = FakeMsearchES([])
+        es.msearch = lambda body: {"responses": [{"error": "SearchPhaseExecutionException", "status": 400}]}
+        with self.assertRaises(elasticsearch.TransportError):
+            PolymorphicS.msearch([self.get_search(es)])
+
 
 class ManagementTestCase(BaseIndexableTestCase):
 
@@ -169,25 +318,59 @@ class ManagementTestCase(BaseIndexableTestCase):
         ParentIndexable.search_objects.refresh()
         self.assertEqual(ParentIndexable.search_objects.query(foo__match="DATA LOVERS").count(), 0)
 
-        # Let's delete an item from the db.
+        # Let's delete an item from the db, which removes its document too
         obj = ParentIndexable.objects.all()[0]
+        obj_type, obj_pk = obj.get_mapping_type_name(), obj.pk
         obj.delete()
+        ParentIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 3)
+        self.assertFalse(es.exists(index=ParentIndexable.get_index_name(), doc_type=obj_type, id=obj_pk))
 
-        # Make sure the count is the same
-        self.assertEqual(ParentIndexable.search_objects.s().count(), 4)
-
-        # This shoulnd't remove the item
+        # This shouldn't bring it back
         call_command("bulk_index")
         ParentIndexable.search_objects.refresh()
-        self.assertEqual(ParentIndexable.search_objects.s().count(), 4)
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 3)
 
-        # This should
+        # Neither should rebuilding the indexes
         call_command("synces", self.index_suffix, drop_existing_indexes=True)
         call_command("es_swap_aliases", self.index_suffix)
         call_command("bulk_index")
         ParentIndexable.search_objects.refresh()
         self.assertEqual(ParentIndexable.search_objects.s().count(), 3)
 
+    def test_bulk_index_window(self):
+        objs = [ParentIndexable(foo="Fighters") for i in range(4)]
+        for obj in objs:
+            obj.save(index=False)
+        call_command("bulk_index", from_pk=objs[1].pk, to_pk=objs[2].pk)
+        ParentIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 2)
+
+        call_command("bulk_index", resume=True)
+        ParentIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 2)
+
+        call_command("bulk_index", chunk=1)
+        ParentIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 4)
+
+    def test_bulk_index_since(self):
+        objs = [DeclarativeIndexable(title="Fighters") for i in range(3)]
+        for obj in objs:
+            obj.save(index=False)
+        DeclarativeIndexable.objects.filter(pk__in=[objs[0].pk, objs[1].pk]).update(
+            last_modified=datetime.datetime(2014, 1, 1))
+        call_command("bulk_index", since="2014-01-02")
+        DeclarativeIndexable.search_objects.refresh()
+        self.assertEqual(DeclarativeIndexable.search_objects.s().count(), 1)
+        # that run left out older objects, so there's no checkpoint to catch up from yet
+        self.assertIsNone(bulk.Checkpoint().get_watermark(DeclarativeIndexable))
+
+        call_command("bulk_index", since="checkpoint")
+        DeclarativeIndexable.search_objects.refresh()
+        self.assertEqual(DeclarativeIndexable.search_objects.s().count(), 3)
+        self.assertIsNotNone(bulk.Checkpoint().get_watermark(DeclarativeIndexable))
+
     def test_index_upgrade(self):
         ParentIndexable(foo="Fighters").save()
         ChildIndexable(foo="Fighters", bar=69).save()
@@ -214,6 +397,304 @@ class ManagementTestCase(BaseIndexableTestCase):
         self.delete_indexes_with_suffix("vtest123")  # clean up
 
 
+class BulkRangesTestCase(TestCase):
+
+    def test_models_to_index(self):
+        self.assertEqual(
+            bulk.get_models_to_index(["testapp"]),
+            [DeclarativeIndexable, ParentIndexable, SeparateIndexable])
+
+    def test_pk_ranges(self):
+        self.assertEqual(bulk.get_pk_ranges(ParentIndexable, 4), [])
+        objs = [ParentIndexable(foo="Fighters") for i in range(5)]
+        objs.append(ChildIndexable(foo="Fighters", bar=69))
+        for obj in objs:
+            obj.save(index=False)
+        first, last = objs[0].pk, objs[-1].pk
+
+        ranges = bulk.get_pk_ranges(ParentIndexable, 4)
+        self.assertTrue(len(ranges) <= 4)
+        self.assertEqual(ranges[0][0], first)
+        self.assertEqual(ranges[-1][1], last)
+        pks = []
+        for pk_range in ranges:
+            pks.extend(obj.pk for obj in bulk.get_queryset(ParentIndexable, pk_range))
+        self.assertEqual(pks, [obj.pk for obj in objs])
+
+        self.assertEqual(bulk.get_pk_ranges(ChildIndexable, 4), [(last, last)])
+        self.assertEqual(len(bulk.get_pk_ranges(ParentIndexable, 100)), 6)
+
+
+class LoadOptionsTestCase(TestCase):
+
+    def test_load_options(self):
+        self.assertEqual(
+            bulk.get_load_options(MixedIndexable), (["id", "junk", "polymorphic_ctype"], [], []))
+
+        class Mapped(object):
+            _meta = ParentIndexable._meta
+
+            @classmethod
+            def get_mapping_type_name(cls):
+                return "mapped"
+
+            @classmethod
+            def get_mapping(cls):
+                return {"mapped": {"properties": {
+                    "foo": {"type": "string"},
+                    "polymorphic_ctype": {"type": "object", "properties": {"model": {"type": "string"}}},
+                    "childindexable": {"type": "object", "properties": {"bar": {"type": "integer"}}},
+                }}}
+
+        self.assertEqual(
+            bulk.get_load_options(Mapped),
+            (["foo", "polymorphic_ctype"], ["polymorphic_ctype"], ["childindexable"]))
+
+        Mapped.get_mapping = classmethod(lambda cls: {"mapped": {"properties": {
+            "foo": {"type": "string"},
+            "shouting": {"type": "string"},
+            "polymorphic_ctype": {"type": "object", "properties": {"model": {"type": "string"}}},
+        }}})
+        # "shouting" might be computed from any column
+        self.assertEqual(bulk.get_load_options(Mapped), (None, ["polymorphic_ctype"], []))
+
+
+class CheckpointTestCase(TestCase):
+
+    def test_checkpoint(self):
+        checkpoint = bulk.Checkpoint("_vtest")
+        self.assertIsNone(checkpoint.get_pending(ParentIndexable))
+
+        checkpoint.start(ParentIndexable, [(1, 10), (11, 20), (21, None)])
+        checkpoint.update(ParentIndexable, (1, 10), last_pk=10, done=True)
+        checkpoint.update(ParentIndexable, (11, 20), last_pk=15)
+        self.assertEqual(
+            checkpoint.get_pending(ParentIndexable),
+            [((11, 20), 15), ((21, None), None)])
+        # other suffixes and models are kept apart
+        self.assertIsNone(bulk.Checkpoint().get_pending(ParentIndexable))
+        self.assertIsNone(checkpoint.get_pending(SeparateIndexable))
+
+        checkpoint.start(ParentIndexable, [(None, None)])
+        self.assertEqual(checkpoint.get_pending(ParentIndexable), [((None, None), None)])
+
+    def test_resume_skips_indexed_objects(self):
+        objs = [ParentIndexable(foo="Fighters") for i in range(3)]
+        for obj in objs:
+            obj.save(index=False)
+        checkpoint = bulk.Checkpoint()
+        checkpoint.start(ParentIndexable, [(None, None)])
+        checkpoint.update(ParentIndexable, (None, None), last_pk=objs[1].pk)
+        (pk_range, after), = checkpoint.get_pending(ParentIndexable)
+        self.assertEqual(list(bulk.get_queryset(ParentIndexable, pk_range, after=after)), objs[2:])
+
+    def test_watermark(self):
+        self.assertIsNone(bulk.get_high_water_mark(DeclarativeIndexable))
+        self.assertIsNone(bulk.get_high_water_mark(ParentIndexable))
+        objs = [DeclarativeIndexable(title="Fighters") for i in range(3)]
+        for obj in objs:
+            obj.save(index=False)
+        DeclarativeIndexable.objects.filter(pk=objs[0].pk).update(
+            last_modified=objs[0].last_modified - datetime.timedelta(days=1))
+        watermark = bulk.get_high_water_mark(DeclarativeIndexable)
+        overlap = datetime.timedelta(seconds=settings.ELASTIMORPHIC_BULK_WATERMARK_OVERLAP)
+        self.assertEqual(watermark, objs[2].last_modified - overlap)
+
+        checkpoint = bulk.Checkpoint("_vtest")
+        self.assertIsNone(checkpoint.get_watermark(DeclarativeIndexable))
+        checkpoint.set_watermark(DeclarativeIndexable, objs[1].last_modified)
+        checkpoint.set_watermark(DeclarativeIndexable, watermark)
+        self.assertEqual(checkpoint.get_watermark(DeclarativeIndexable), watermark)
+        self.assertIsNone(bulk.Checkpoint().get_watermark(DeclarativeIndexable))
+
+        since = objs[1].last_modified
+        self.assertEqual(list(bulk.get_queryset(DeclarativeIndexable, since=since)), objs[1:])
+
+    def test_watermark_since(self):
+        checkpoint = bulk.Checkpoint()
+        DeclarativeIndexable(title="Fighters").save(index=False)
+        recorded = datetime.datetime(2014, 1, 1)
+        checkpoint.set_watermark(DeclarativeIndexable, recorded)
+
+        # a run that started after the recorded mark leaves a gap, so it doesn't move the mark
+        command = bulk_index.Command()
+        command.stdout = command.stderr = six.StringIO()
+        command.index = lambda tasks: None
+        command.handle(since="2014-01-02", index_suffix="")
+        self.assertEqual(checkpoint.get_watermark(DeclarativeIndexable), recorded)
+        command.handle(since="2013-12-31", index_suffix="")
+        self.assertGreater(checkpoint.get_watermark(DeclarativeIndexable), recorded)
+
+
+class FakeBulkES(object):
+    """Stands in for the elasticsearch client, rejecting the documents listed in `rejections`
+    (one set of positions per request)."""
+
+    transport = elasticsearch.Transport([{}])
+
+    def __init__(self, rejections=()):
+        self.rejections = list(rejections)
+        self.requests = []
+        self.actions = []
+
+    def bulk(self, body):
+        lines = body.splitlines()
+        self.actions.append([json.loads(line) for line in lines[0::2]])
+        self.requests.append(lines[1::2])
+        rejected = self.rejections.pop(0) if self.rejections else ()
+        items = []
+        for position in range(len(lines) // 2):
+            if position in rejected:
+                items.append({"index": {"status": 429, "error": "EsRejectedExecutionException[rejected execution]"}})
+            else:
+                items.append({"index": {"status": 201}})
+        return {"items": items}
+
+
+class BulkIndexerTestCase(TestCase):
+
+    def setUp(self):
+        super(BulkIndexerTestCase, self).setUp()
+        self.objs = [ParentIndexable(foo="Fighters") for i in range(6)]
+        for obj in self.objs:
+            obj.save(index=False)
+
+    def test_index_range_errors(self):
+        task = (0, ParentIndexable, (None, None), None, None, {"es": FakeBulkES()})
+        errors = [elasticsearch.TransportError(500, "Internal error"), ValueError("broken")]
+
+        def index_rows(indexer, queryset, progress=None):
+            raise errors.pop(0)
+
+        backup_index_rows = bulk.BulkIndexer.index_rows
+        bulk.BulkIndexer.index_rows = index_rows
+        try:
+            task_id, count, error, timings = bulk.index_range(task)
+            self.assertIn("Internal error", error)
+            # anything else is a bug, which shouldn't be reported as just a failed run
+            with self.assertRaises(ValueError):
+                bulk.index_range(task)
+            # worker processes return the traceback instead
+            errors.append(ValueError("broken"))
+            bulk.init_worker(object())
+            task_id, count, error, timings = bulk.index_range(task, progress=lambda count, last_pk: None)
+            self.assertIn("Traceback", error)
+            self.assertIn("ValueError: broken", error)
+        finally:
+            bulk.BulkIndexer.index_rows = backup_index_rows
+            bulk.init_worker(None)
+
+    def test_default_chunk_size(self):
+        backup_chunk_size = settings.ELASTIMORPHIC_BULK_CHUNK_SIZE
+        settings.ELASTIMORPHIC_BULK_CHUNK_SIZE = 69
+        try:
+            self.assertEqual(bulk.BulkIndexer(es=FakeBulkES()).max_chunk_size, 69)
+        finally:
+            settings.ELASTIMORPHIC_BULK_CHUNK_SIZE = backup_chunk_size
+
+    def test_chunks_by_size(self):
+        es = FakeBulkES()
+        indexer = bulk.BulkIndexer(chunk_size=4, es=es, target_seconds=60)
+        size = len(indexer.serialize(self.objs[0]))
+        progress = []
+        self.assertEqual(indexer.index(self.objs, progress=lambda *args: progress.append(args)), 6)
+        self.assertEqual([len(request) for request in es.requests], [4, 2])
+        self.assertEqual(progress, [(4, self.objs[3].pk), (6, self.objs[5].pk)])
+
+        es = FakeBulkES()
+        indexer = bulk.BulkIndexer(chunk_size=4, es=es, max_bytes=size * 2, target_seconds=60)
+        indexer.index(self.objs)
+        self.assertEqual([len(request) for request in es.requests], [2, 2, 2])
+
+    def test_retries_rejected_documents(self):
+        es = FakeBulkES(rejections=[{1, 3}, {0}])
+        indexer = bulk.BulkIndexer(chunk_size=6, es=es, retry_backoff=0, target_seconds=60)
+        self.assertEqual(indexer.index(self.objs), 6)
+        self.assertEqual([len(request) for request in es.requests], [6, 2, 1])
+        self.assertEqual(es.requests[1], [es.requests[0][1], es.requests[0][3]])
+        # rejections shrink the chunks, and fast requests grow them back
+        self.assertEqual(indexer.chunk_size, 2)
+
+    def test_gives_up_after_retries(self):
+        es = FakeBulkES(rejections=[{0}] * 3)
+        indexer = bulk.BulkIndexer(chunk_size=6, es=es, max_retries=2, retry_backoff=0)
+        with self.assertRaises(bulk.BulkIndexError):
+            indexer.index(self.objs)
+        self.assertEqual(len(es.requests), 3)
+
+    def test_pipeline(self):
+        es = FakeBulkES(rejections=[{0}])
+        indexer = bulk.BulkIndexer(chunk_size=2, es=es, retry_backoff=0, target_seconds=60, senders=3)
+        progress = []
+        self.assertEqual(indexer.index(self.objs, progress=lambda *args: progress.append(args)), 6)
+        # the rejected document is sent again
+        self.assertEqual(len(sum(es.requests, [])), 7)
+        self.assertEqual(len(set(sum(es.requests, []))), 6)
+        # progress only moves past chunks once everything before them was sent
+        self.assertEqual([count for count, last_pk in progress], sorted(count for count, last_pk in progress))
+        self.assertEqual(progress[-1], (6, self.objs[-1].pk))
+        self.assertEqual(sorted(indexer.timings), sorted(bulk.STAGES))
+        self.assertTrue(indexer.timings["send"] > 0)
+
+    def test_pipeline_error(self):
+        es = FakeBulkES(rejections=[{0}] * 10)
+        indexer = bulk.BulkIndexer(chunk_size=1, es=es, max_retries=0, retry_backoff=0, senders=2)
+        with self.assertRaises(bulk.BulkIndexError):
+            indexer.index(self.objs)
+
+    def test_index_rows(self):
+        objs = [
+            DeclarativeIndexable(title="Fighters", views=3, published=datetime.datetime(2014, 4, 23, 9)),
+            DeclarativeChildIndexable(title="Fighters", rating=4.5),
+            DeclarativeIndexable(title="Fighters", body="Not indexed"),
+        ]
+        for obj in objs:
+            obj.save(index=False)
+        self.assertTrue(bulk.get_columns(DeclarativeIndexable))
+        self.assertIsNone(bulk.get_columns(ParentIndexable))
+        # nested documents are built from instances
+        self.assertIsNone(bulk.get_columns(DeclarativeChildIndexable))
+
+        es = FakeBulkES()
+        indexer = bulk.BulkIndexer(chunk_size=10, es=es, target_seconds=60)
+        # the pks and ctypes, then one query for each class
+        ContentType.objects.get_for_model(DeclarativeChildIndexable, for_concrete_model=False)
+        with self.assertNumQueries(3):
+            self.assertEqual(indexer.index_rows(bulk.get_queryset(DeclarativeIndexable)), 3)
+        documents = [json.loads(line) for line in es.requests[0]]
+        self.assertEqual(documents, [
+            json.loads(json.dumps(obj.extract_document())) for obj in
+            DeclarativeIndexable.objects.order_by("pk")
+        ])
+        self.assertEqual(documents[0]["published"], "2014-04-23T09:00:00")
+        self.assertEqual(documents[1]["rating"], 4.5)
+        self.assertNotIn("body", documents[2])
+
+    def test_index_rows_loads_mapped_columns(self):
+        objs = [SeparateIndexable(junk="Fighters"), MixedIndexable(junk="Fighters", itsa="Not indexed")]
+        for obj in objs:
+            obj.save(index=False)
+        es = FakeBulkES()
+        indexer = bulk.BulkIndexer(chunk_size=10, es=es, target_seconds=60)
+        ContentType.objects.get_for_model(MixedIndexable, for_concrete_model=False)
+        with CaptureQueriesContext(db_connection) as queries:
+            self.assertEqual(indexer.index_rows(bulk.get_queryset(SeparateIndexable)), 2)
+        self.assertEqual(len(queries), 3)
+        self.assertNotIn("itsa", queries[2]["sql"])
+        self.assertIn("junk", queries[2]["sql"])
+        documents = [json.loads(line) for line in es.requests[0]]
+        self.assertEqual(documents[1], json.loads(json.dumps(objs[1].extract_document())))
+        # deferred instances are still indexed under their model's type
+        self.assertEqual(
+            [action["index"]["_type"] for action in es.actions[0]],
+            ["testapp_separateindexable", "testapp_mixedindexable"])
+
+    def test_slow_requests_shrink_chunks(self):
+        indexer = bulk.BulkIndexer(chunk_size=8, es=FakeBulkES(), target_seconds=-1)
+        indexer.index(self.objs[:1])
+        self.assertEqual(indexer.chunk_size, 4)
+
+
 class TestDynamicMappings(BaseIndexableTestCase):
 
     maxDiff = 2000
@@ -244,6 +725,822 @@ class TestDynamicMappings(BaseIndexableTestCase):
         self.assertDictEqual(mapping, ParentIndexable.get_mapping())
 
 
+class IndexingBatchTestCase(TestCase):
+
+    def test_batch_merges_saves(self):
+        with self.assertRaises(ValueError):
+            with indexing.batch() as batch:
+                obj = ParentIndexable(foo="Fighters")
+                obj.save()
+                obj.foo = "Foo Fighters"
+                obj.save()
+                ChildIndexable(foo="Fighters", bar=69).save()
+                self.assertEqual(len(batch), 2)
+                # nothing gets sent when the block fails
+                raise ValueError
+
+    def test_nested_batches(self):
+        with self.assertRaises(ValueError):
+            with indexing.batch() as outer:
+                ParentIndexable(foo="Fighters").save()
+                with indexing.batch() as inner:
+                    ParentIndexable(foo="Fighters").save()
+                    self.assertEqual(len(inner), 1)
+                self.assertEqual(len(outer), 2)
+                with self.assertRaises(ValueError):
+                    with indexing.batch():
+                        ParentIndexable(foo="Fighters").save()
+                        raise ValueError
+                self.assertEqual(len(outer), 2)
+                raise ValueError
+
+    def test_save_without_index(self):
+        with self.assertRaises(ValueError):
+            with indexing.batch() as batch:
+                ParentIndexable(foo="Fighters").save(index=False)
+                self.assertEqual(len(batch), 0)
+                raise ValueError
+
+
+class BatchIndexingTestCase(BaseIndexableTestCase):
+
+    def test_batch(self):
+        with indexing.batch():
+            ParentIndexable.objects.create(foo="Fighters")
+            ChildIndexable.objects.create(foo="Fighters", bar=69)
+            SeparateIndexable.objects.create(junk="Testing")
+            ParentIndexable.search_objects.refresh()
+            self.assertEqual(ParentIndexable.search_objects.s().count(), 0)
+        ParentIndexable.search_objects.refresh()
+        SeparateIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 2)
+        self.assertEqual(SeparateIndexable.search_objects.s().count(), 1)
+
+
+class FakeUpdateES(object):
+    """Records the documents sent by Indexable.index() and indexing batches."""
+
+    def __init__(self):
+        self.documents = []
+
+    def update(self, index, doc_type, id, body):
+        self.documents.append(body["doc"])
+
+    def bulk(self, body, refresh=False):
+        self.documents.extend(line["doc"] for line in body[1::2])
+        return {"items": [{"update": {"status": 200}} for line in body[1::2]]}
+
+
+class DocumentHashTestCase(TestCase):
+
+    def setUp(self):
+        super(DocumentHashTestCase, self).setUp()
+        self.backup_skip = settings.ELASTIMORPHIC_SKIP_UNCHANGED
+        settings.ELASTIMORPHIC_SKIP_UNCHANGED = True
+        self.objs = [DeclarativeIndexable(title="Fighters", views=i) for i in range(3)]
+        for obj in self.objs:
+            obj.save(index=False)
+
+    def tearDown(self):
+        settings.ELASTIMORPHIC_SKIP_UNCHANGED = self.backup_skip
+        super(DocumentHashTestCase, self).tearDown()
+
+    def test_document_hash(self):
+        self.assertEqual(
+            hashes.get_document_hash({"a": 1, "b": [datetime.date(2014, 4, 23)]}),
+            hashes.get_document_hash(copy.deepcopy({"b": [datetime.date(2014, 4, 23)], "a": 1})))
+        self.assertNotEqual(hashes.get_document_hash({"a": 1}), hashes.get_document_hash({"a": 2}))
+
+    def test_filter_unchanged(self):
+        lines = []
+        for obj in self.objs:
+            lines.extend(indexing.get_index_actions(obj))
+        remaining, entries = hashes.filter_unchanged(lines)
+        self.assertEqual(remaining, lines)
+        hashes.record(entries[:2])
+
+        self.objs[0].views = 69
+        lines = []
+        for obj in self.objs:
+            lines.extend(indexing.get_index_actions(obj))
+        remaining, entries = hashes.filter_unchanged(lines)
+        self.assertEqual(remaining, lines[:2] + lines[4:])
+        self.assertEqual(len(entries), 2)
+
+        hashes.forget([self.objs[0].get_index_name()])
+        self.assertEqual(hashes.filter_unchanged(lines)[0], lines)
+
+    def test_index_skips_unchanged(self):
+        es = FakeUpdateES()
+        obj = self.objs[0]
+        obj.get_es = lambda: es
+        obj.index()
+        obj.index()
+        self.assertEqual(len(es.documents), 1)
+        obj.title = "Foo Fighters"
+        obj.index()
+        self.assertEqual(len(es.documents), 2)
+
+        batch = indexing.IndexingBatch()
+        for obj in self.objs:
+            batch.add(obj)
+        batch.flush(es=es)
+        self.assertEqual([document["views"] for document in es.documents[2:]], [1, 2])
+
+    def test_synces_forgets_dropped(self):
+        class FakeIndicesES(object):
+            def __init__(self):
+                self.indices = self
+
+            def get_aliases(self, index):
+                return {index: {"aliases": {DeclarativeIndexable.get_index_name(): {}}}}
+
+            def delete(self, index, ignore=None):
+                pass
+
+            def create(self, index, body):
+                pass
+
+            def put_mapping(self, index, doc_type, body):
+                pass
+
+        lines = indexing.get_index_actions(self.objs[0])
+        entries = [hashes.get_entry(*lines)]
+        hashes.record(entries)
+        index = DeclarativeIndexable.get_index_name() + "_vtest"
+        hashes.record([((index,) + entries[0][0][1:], entries[0][1])])
+        backup_get_es = synces.get_es
+        synces.get_es = FakeIndicesES
+        try:
+            call_command("synces", "vtest", drop_existing_indexes=True)
+        finally:
+            synces.get_es = backup_get_es
+        self.assertEqual(hashes.filter_unchanged(lines)[0], lines)
+        self.assertFalse(IndexedDocument.objects.filter(index=index).exists())
+
+    def test_bulk_only_changed(self):
+        for senders in (0, 2):
+            hashes.forget([DeclarativeIndexable.get_index_name()])
+            es = FakeBulkES()
+            queryset = bulk.get_queryset(DeclarativeIndexable)
+            indexer = bulk.BulkIndexer(chunk_size=2, es=es, senders=senders, only_changed=True)
+            self.assertEqual(indexer.index_rows(queryset), 3)
+            self.assertEqual(indexer.index_rows(queryset), 0)
+            self.assertEqual(indexer.skipped, 3)
+
+            self.objs[1].views += 10
+            self.objs[1].save(index=False)
+            self.assertEqual(indexer.index_rows(queryset), 1)
+            self.assertEqual(json.loads(es.requests[-1][0])["views"], self.objs[1].views)
+
+
+class FakePartialES(FakeUpdateES):
+    """Like FakeUpdateES, but partial updates (without doc_as_upsert) of documents which
+    weren't indexed yet fail."""
+
+    def __init__(self):
+        super(FakePartialES, self).__init__()
+        self.indexed = set()
+
+    def update(self, index, doc_type, id, body):
+        if not body.get("doc_as_upsert") and id not in self.indexed:
+            raise elasticsearch.NotFoundError(404, "DocumentMissingException")
+        self.indexed.add(id)
+        super(FakePartialES, self).update(index, doc_type, id, body)
+
+    def bulk(self, body, refresh=False):
+        items = []
+        for action, line in zip(body[::2], body[1::2]):
+            id = action["update"]["_id"]
+            if not line.get("doc_as_upsert") and id not in self.indexed:
+                items.append({"update": {"status": 404, "error": "DocumentMissingException"}})
+            else:
+                self.indexed.add(id)
+                self.documents.append(line["doc"])
+                items.append({"update": {"status": 200}})
+        return {"items": items}
+
+
+class PartialUpdateTestCase(TestCase):
+
+    def setUp(self):
+        super(PartialUpdateTestCase, self).setUp()
+        self.backup_partial = settings.ELASTIMORPHIC_PARTIAL_UPDATES
+        settings.ELASTIMORPHIC_PARTIAL_UPDATES = True
+        self.es = FakePartialES()
+        for i in range(3):
+            DeclarativeIndexable(title="Fighters", views=i).save(index=False)
+        self.objs = list(DeclarativeIndexable.objects.order_by("pk"))
+        for obj in self.objs:
+            obj.get_es = lambda: self.es
+
+    def tearDown(self):
+        settings.ELASTIMORPHIC_PARTIAL_UPDATES = self.backup_partial
+        super(PartialUpdateTestCase, self).tearDown()
+
+    def test_changed_fields(self):
+        obj = self.objs[0]
+        self.assertEqual(obj.get_changed_fields(), set())
+        # it might not have been indexed yet
+        self.assertIsNone(obj.get_partial_document())
+        obj.reset_indexed_state()
+        self.assertEqual(obj.get_partial_document(), {})
+        obj.views = 69
+        obj.body = "Not indexed"
+        self.assertEqual(obj.get_changed_fields(), set(["views"]))
+        self.assertEqual(obj.get_partial_document(), {"views": 69})
+        self.assertIsNone(DeclarativeIndexable(title="Fighters").get_partial_document())
+        self.assertIsNone(ParentIndexable.get_document_sources())
+
+    def test_loaded_state(self):
+        obj = DeclarativeIndexable.objects.get(pk=self.objs[0].pk)
+        self.assertEqual(obj._loaded_state["views"], 0)
+        self.assertNotIn("body", obj._loaded_state)
+        settings.ELASTIMORPHIC_PARTIAL_UPDATES = False
+        obj = DeclarativeIndexable.objects.get(pk=self.objs[0].pk)
+        self.assertNotIn("_loaded_state", obj.__dict__)
+
+    def test_index_sends_changes(self):
+        obj = self.objs[0]
+        self.es.indexed.add(obj.pk)
+        obj.reset_indexed_state()
+        obj.body = "Not indexed"
+        obj.index()
+        self.assertEqual(self.es.documents, [])
+
+        obj.views = 69
+        obj.index()
+        self.assertEqual(self.es.documents, [{"views": 69}])
+        obj.index()
+        self.assertEqual(len(self.es.documents), 1)
+
+    def test_never_indexed(self):
+        # the objects were saved with index=False, so elasticsearch doesn't have them
+        obj = self.objs[0]
+        obj.body = "Not indexed"
+        obj.save()
+        self.assertEqual(self.es.documents, [obj.extract_document()])
+        obj.body = "Still not indexed"
+        obj.save()
+        self.assertEqual(len(self.es.documents), 1)
+
+    def test_missing_document_sent_in_full(self):
+        obj = self.objs[0]
+        obj.views = 69
+        obj.index()
+        self.assertEqual(self.es.documents, [obj.extract_document()])
+
+    def test_batch(self):
+        self.es.indexed.update([self.objs[0].pk, self.objs[1].pk])
+        batch = indexing.IndexingBatch()
+        for obj in self.objs:
+            obj.title = "Foo Fighters"
+            batch.add(obj)
+        self.objs[1].views = 69
+        batch.flush(es=self.es)
+        self.assertEqual(self.es.documents, [
+            {"title": "Foo Fighters"},
+            {"title": "Foo Fighters", "views": 69},
+            self.objs[2].extract_document(),
+        ])
+        self.assertEqual(self.objs[2].get_partial_document(), {})
+
+
+class FakeDeleteES(FakeUpdateES):
+    """Also records the documents removed, by (type, id)."""
+
+    def __init__(self):
+        super(FakeDeleteES, self).__init__()
+        self.deleted = []
+
+    def delete(self, index, doc_type, id, refresh=False, ignore=None):
+        self.deleted.append((doc_type, id))
+
+    def bulk(self, body, refresh=False):
+        if "delete" not in body[0]:
+            return super(FakeDeleteES, self).bulk(body, refresh=refresh)
+        self.deleted.extend((line["delete"]["_type"], line["delete"]["_id"]) for line in body)
+        # documents which were never indexed are already gone
+        return {"items": [{"delete": {"status": 404, "found": False}} for line in body]}
+
+
+class DeleteTestCase(TestCase):
+
+    def setUp(self):
+        super(DeleteTestCase, self).setUp()
+        self.parent = ParentIndexable(foo="Fighters")
+        self.parent.save(index=False)
+        self.child = ChildIndexable(foo="Fighters", bar=69)
+        self.child.save(index=False)
+        self.separate = SeparateIndexable(junk="Testing")
+        self.separate.save(index=False)
+
+    def test_delete(self):
+        es = FakeDeleteES()
+        self.separate.get_es = lambda: es
+        pk = self.separate.pk
+        self.separate.delete()
+        self.assertEqual(es.deleted, [("testapp_separateindexable", pk)])
+
+    def test_delete_deferred(self):
+        es = FakeDeleteES()
+        pks = [self.child.pk, self.separate.pk]
+        with indexing.batch() as batch:
+            ChildIndexable.objects.non_polymorphic().only("id").get(pk=self.child.pk).delete()
+            SeparateIndexable.objects.only("id").get(pk=self.separate.pk).delete()
+            batch.flush(es=es)
+        self.assertEqual(es.deleted, [
+            ("testapp_childindexable", pks[0]), ("testapp_separateindexable", pks[1])])
+
+    def test_queryset_delete_is_batched(self):
+        with self.assertRaises(ValueError):
+            with indexing.batch() as batch:
+                ParentIndexable.objects.filter(foo="Fighters").delete()
+                SeparateIndexable.objects.all().delete()
+                self.assertEqual(
+                    sorted((action["delete"]["_type"], action["delete"]["_id"])
+                           for action in batch.get_delete_actions()), [
+                        ("testapp_childindexable", self.child.pk),
+                        ("testapp_parentindexable", self.parent.pk),
+                        ("testapp_separateindexable", self.separate.pk),
+                    ])
+                raise ValueError
+
+    def test_flush(self):
+        es = FakeDeleteES()
+        batch = indexing.IndexingBatch()
+        batch.add(self.parent)
+        batch.add(self.child)
+        batch.delete(self.child, ChildIndexable, self.child.pk)
+        batch.flush(es=es)
+        self.assertEqual(len(es.documents), 1)
+        self.assertEqual(es.deleted, [("testapp_childindexable", self.child.pk)])
+
+    def test_delete_forgets_hash(self):
+        lines = indexing.get_index_actions(self.parent)
+        delete = indexing.get_delete_action(ParentIndexable, self.parent.pk)
+        remaining, entries = hashes.filter_unchanged(lines + [delete])
+        self.assertEqual(remaining, lines + [delete])
+        hashes.record(entries[:1])
+        self.assertEqual(hashes.filter_unchanged(lines + [delete])[0], [delete])
+        hashes.record(entries[1:])
+        self.assertEqual(hashes.filter_unchanged(lines)[0], lines)
+
+
+class QueueSettingsMixin(object):
+    queue_backend = "elastimorphic.queues.LocalQueue"
+
+    def setUp(self):
+        super(QueueSettingsMixin, self).setUp()
+        self.backup_queue = settings.ELASTIMORPHIC_INDEX_QUEUE
+        settings.ELASTIMORPHIC_INDEX_QUEUE = self.queue_backend
+        queues._queues.clear()
+        self.queue = queues.get_index_queue()
+
+    def tearDown(self):
+        settings.ELASTIMORPHIC_INDEX_QUEUE = self.backup_queue
+        queues._queues.clear()
+        super(QueueSettingsMixin, self).tearDown()
+
+
+class OnCommitTestCase(TestCase):
+    """Stubs the on_commit() hook that django-transaction-hooks adds to connections (the test
+    itself runs in a transaction which is never committed, so commit() runs the callbacks)."""
+
+    def setUp(self):
+        super(OnCommitTestCase, self).setUp()
+        self.backup_on_commit = settings.ELASTIMORPHIC_INDEX_ON_COMMIT
+        settings.ELASTIMORPHIC_INDEX_ON_COMMIT = True
+        self.es = FakeDeleteES()
+        self.backup_get_es = indexing.get_es
+        indexing.get_es = lambda: self.es
+        db_connection.run_on_commit = []
+        db_connection.on_commit = lambda func: db_connection.run_on_commit.append(
+            (set(db_connection.savepoint_ids), func))
+
+    def tearDown(self):
+        db_connection.__dict__.pop("on_commit", None)
+        del db_connection.run_on_commit
+        indexing.indexing_buffer.pending.clear()
+        indexing.get_es = self.backup_get_es
+        settings.ELASTIMORPHIC_INDEX_ON_COMMIT = self.backup_on_commit
+        super(OnCommitTestCase, self).tearDown()
+
+    def commit(self):
+        while db_connection.run_on_commit:
+            sids, func = db_connection.run_on_commit.pop(0)
+            func()
+
+    def test_commit(self):
+        obj = DeclarativeIndexable.objects.create(title="Fighters")
+        obj.title = "Foo Fighters"
+        obj.save()
+        self.assertEqual(self.es.documents, [])
+        self.commit()
+        self.assertEqual([doc["title"] for doc in self.es.documents], ["Foo Fighters"])
+
+    def test_rollback(self):
+        DeclarativeIndexable.objects.create(title="Fighters")
+        # a rollback drops the callbacks of the transaction
+        db_connection.run_on_commit = []
+        DeclarativeIndexable.objects.create(title="Foo Fighters")
+        self.commit()
+        self.assertEqual([doc["title"] for doc in self.es.documents], ["Foo Fighters"])
+
+    def test_savepoint_rollback(self):
+        obj = DeclarativeIndexable.objects.create(title="Fighters")
+        other = DeclarativeIndexable.objects.create(title="Other")
+        other_pk = other.pk
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                obj.title = "Foo Fighters"
+                obj.save()
+                DeclarativeIndexable.objects.create(title="Rolled back")
+                other.delete()
+                raise ValueError
+        self.commit()
+        self.assertEqual(sorted(doc["title"] for doc in self.es.documents), ["Fighters", "Other"])
+        self.assertEqual(self.es.deleted, [])
+        self.assertTrue(DeclarativeIndexable.objects.filter(pk=other_pk).exists())
+
+    def test_savepoint_commit(self):
+        with transaction.atomic():
+            obj = DeclarativeIndexable.objects.create(title="Fighters")
+            # so that SQLite doesn't give the deleted object's id to the new one
+            DeclarativeIndexable.objects.create(title="Other")
+        pk = obj.pk
+        with transaction.atomic():
+            obj.delete()
+            DeclarativeIndexable.objects.create(title="Foo Fighters")
+        self.commit()
+        self.assertEqual(sorted(doc["title"] for doc in self.es.documents), ["Foo Fighters", "Other"])
+        self.assertEqual(self.es.deleted, [("testapp_declarativeindexable", pk)])
+
+    def test_skip_unchanged(self):
+        settings.ELASTIMORPHIC_INDEX_ON_COMMIT = False
+        backup_skip = settings.ELASTIMORPHIC_SKIP_UNCHANGED
+        settings.ELASTIMORPHIC_SKIP_UNCHANGED = True
+        try:
+            DeclarativeIndexable.objects.create(title="Fighters")
+            # the hashes would be rolled back with the transaction, so nothing's sent until then
+            self.assertEqual(self.es.documents, [])
+            self.assertFalse(IndexedDocument.objects.exists())
+            self.commit()
+            self.assertEqual([doc["title"] for doc in self.es.documents], ["Fighters"])
+            self.assertEqual(IndexedDocument.objects.count(), 1)
+        finally:
+            settings.ELASTIMORPHIC_SKIP_UNCHANGED = backup_skip
+
+    def test_not_configured(self):
+        del db_connection.on_commit
+        with self.assertRaises(ImproperlyConfigured):
+            DeclarativeIndexable.objects.create(title="Fighters")
+
+
+class LocalQueueTestCase(QueueSettingsMixin, TestCase):
+
+    def test_index_is_queued(self):
+        parent = ParentIndexable.objects.create(foo="Fighters")
+        child = ChildIndexable.objects.create(foo="Fighters", bar=69)
+        parent.save()
+        self.assertEqual(len(self.queue), 3)
+        items = self.queue.get(10)
+        self.assertEqual(
+            [(item.model, item.pk, item.op) for item in items], [
+                (ParentIndexable, parent.pk, "index"),
+                (ChildIndexable, child.pk, "index"),
+                (ParentIndexable, parent.pk, "index"),
+            ])
+        self.queue.ack(items[:2])
+        # the last item is still claimed
+        self.assertEqual(self.queue.get(10), [])
+        self.queue.release(items[2:])
+        self.assertEqual(self.queue.get(10), items[2:])
+
+    def test_deferred(self):
+        parent = ParentIndexable.objects.create(foo="Fighters")
+        self.queue.ack(self.queue.get(10))
+        deferred = ParentIndexable.objects.non_polymorphic().only("id").get(pk=parent.pk)
+        deferred.index()
+        self.assertEqual(
+            [(item.model, item.pk, item.op) for item in self.queue.get(10)],
+            [(ParentIndexable, parent.pk, "index")])
+        ctype_id = polymorphic_indexable_registry.get_ctype_id(deferred.__class__)
+        self.assertIs(polymorphic_indexable_registry.get_ctype_model(ctype_id), ParentIndexable)
+
+    def test_lease(self):
+        backup_lease = settings.ELASTIMORPHIC_INDEX_QUEUE_LEASE
+        parent = ParentIndexable.objects.create(foo="Fighters")
+        try:
+            settings.ELASTIMORPHIC_INDEX_QUEUE_LEASE = 0
+            self.assertEqual([item.pk for item in self.queue.get(10)], [parent.pk])
+            # the claim ran out right away
+            self.assertEqual([item.pk for item in self.queue.get(10)], [parent.pk])
+        finally:
+            settings.ELASTIMORPHIC_INDEX_QUEUE_LEASE = backup_lease
+
+    def test_worker_error(self):
+        class FailingES(object):
+            def bulk(self, body):
+                raise elasticsearch.TransportError(500, "Oops")
+
+        backup_get_es = es_index_worker.get_es
+        es_index_worker.get_es = FailingES
+        parent = ParentIndexable.objects.create(foo="Fighters")
+        try:
+            command = es_index_worker.Command()
+            command.stdout = command.stderr = six.StringIO()
+            self.assertEqual(command.handle(once=True, interval=0), "Bulk indexing failed.")
+        finally:
+            es_index_worker.get_es = backup_get_es
+        # the failed items were released, so they're tried again
+        self.assertEqual([item.pk for item in self.queue.get(10)], [parent.pk])
+
+    def test_build_payload(self):
+        parent = ParentIndexable.objects.create(foo="Fighters")
+        child = ChildIndexable.objects.create(foo="Fighters", bar=69)
+        deleted = ParentIndexable.objects.create(foo="Fighters")
+        deleted_pk = deleted.pk
+        parent.save()
+        deleted.delete()
+        payload = queues.build_payload(self.queue.get(10))
+        self.assertEqual(len(payload), 5)
+        self.assertEqual(payload[0]["update"]["_id"], child.pk)
+        self.assertEqual(payload[1]["doc"]["bar"], 69)
+        self.assertEqual(payload[2]["update"]["_id"], parent.pk)
+        self.assertEqual(payload[2]["update"]["_type"], "testapp_parentindexable")
+        self.assertEqual(payload[4]["delete"]["_id"], deleted_pk)
+
+
+class QuerySetIndexingTestCase(QueueSettingsMixin, TestCase):
+
+    def setUp(self):
+        super(QuerySetIndexingTestCase, self).setUp()
+        self.backup_partial = settings.ELASTIMORPHIC_PARTIAL_UPDATES
+
+    def tearDown(self):
+        settings.ELASTIMORPHIC_PARTIAL_UPDATES = self.backup_partial
+        super(QuerySetIndexingTestCase, self).tearDown()
+
+    def test_update(self):
+        parent = ParentIndexable.objects.create(foo="Fighters")
+        child = ChildIndexable.objects.create(foo="Fighters", bar=69)
+        self.queue.ack(self.queue.get(10))
+        self.assertEqual(ParentIndexable.search_objects.all().update(foo="Foo Fighters"), 2)
+        self.assertEqual(
+            [(item.model, item.pk) for item in self.queue.get(10)],
+            [(ParentIndexable, parent.pk), (ChildIndexable, child.pk)])
+
+    @unittest.skipIf(django.VERSION < (1, 7), "QuerySet.update() takes attnames since Django 1.7")
+    def test_update_attname(self):
+        author = Author.objects.create(name="Dave")
+        obj = DeclarativeChildIndexable.objects.create(title="Fighters")
+        self.queue.ack(self.queue.get(10))
+        DeclarativeChildIndexable.search_objects.all().update(author_id=author.pk)
+        self.assertEqual(DeclarativeChildIndexable.objects.get(pk=obj.pk).author, author)
+        self.assertEqual([(item.model, item.pk) for item in self.queue.get(10)], [
+            (DeclarativeChildIndexable, obj.pk)])
+
+    def test_bulk_create(self):
+        SeparateIndexable.search_objects.bulk_create([
+            SeparateIndexable(id=1, junk="Testing"), SeparateIndexable(id=2, junk="Testing")])
+        self.assertEqual([(item.model, item.pk) for item in self.queue.get(10)], [
+            (SeparateIndexable, 1), (SeparateIndexable, 2)])
+        self.assertIsNotNone(SeparateIndexable.objects.get(id=1).polymorphic_ctype_id)
+
+    def test_partial_update(self):
+        settings.ELASTIMORPHIC_PARTIAL_UPDATES = True
+        obj = DeclarativeIndexable.objects.create(title="Fighters", views=1)
+        self.queue.ack(self.queue.get(10))
+        DeclarativeIndexable.search_objects.all().update(body="Not indexed")
+        self.assertEqual(len(self.queue), 0)
+        DeclarativeIndexable.search_objects.all().update(views=F("views") + 1)
+        self.assertEqual([item.pk for item in self.queue.get(10)], [obj.pk])
+
+    def test_index_pks(self):
+        objs = [DeclarativeIndexable.objects.create(title="Fighters", views=i) for i in range(3)]
+        DeclarativeIndexable.search_objects.all().update(views=F("views") + 1)
+        es = FakePartialES()
+        es.indexed.update([objs[0].pk, objs[1].pk])
+        indexing.index_pks(DeclarativeIndexable, [obj.pk for obj in objs], ["views"], es=es)
+        self.assertEqual(es.documents[:2], [{"views": 1}, {"views": 2}])
+        # the last one wasn't indexed yet, so it's sent in full
+        self.assertEqual(es.documents[2]["title"], "Fighters")
+        self.assertEqual(es.documents[2]["views"], 3)
+
+
+class DatabaseQueueTestCase(LocalQueueTestCase):
+    queue_backend = "elastimorphic.queues.DatabaseQueue"
+
+
+class IndexWorkerTestCase(QueueSettingsMixin, BaseIndexableTestCase):
+
+    def test_worker(self):
+        ParentIndexable.objects.create(foo="Fighters")
+        ChildIndexable.objects.create(foo="Fighters", bar=69)
+        SeparateIndexable.objects.create(junk="Testing")
+        ParentIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 0)
+
+        call_command("es_index_worker", once=True, batch_size=1, concurrency=2)
+        ParentIndexable.search_objects.refresh()
+        SeparateIndexable.search_objects.refresh()
+        self.assertEqual(ParentIndexable.search_objects.s().count(), 2)
+        self.assertEqual(SeparateIndexable.search_objects.s().count(), 1)
+        self.assertEqual(len(self.queue), 0)
+
+
+class FakeSearchES(FakeDeleteES):
+    """Answers searches with some canned hits, and records them."""
+
+    def __init__(self, hits=()):
+        super(FakeSearchES, self).__init__()
+        self.hits = list(hits)
+        self.searches = []
+
+    def search(self, body, index, doc_type, **kwargs):
+        self.searches.append(body)
+        hits = self.hits[:body.get("size", len(self.hits))]
+        return {"took": 1, "hits": {"total": len(self.hits), "max_score": 1.0, "hits": hits}}
+
+
+class BackgroundTestCase(TestCase):
+
+    def setUp(self):
+        super(BackgroundTestCase, self).setUp()
+        self.child = ChildIndexable(foo="Fighters", bar=69)
+        self.child.save(index=False)
+        self.grandchild = GrandchildIndexable(foo="Fighters", bar=69, baz=datetime.date.today())
+        self.grandchild.save(index=False)
+        self.es = FakeSearchES([
+            {"_id": str(obj.pk), "_type": obj.get_mapping_type_name()} for obj in (self.child, self.grandchild)
+        ])
+        self.backup_get_async_es = background.get_async_es
+        background.get_async_es = lambda *args, **kwargs: self.es
+
+    def tearDown(self):
+        background.get_async_es = self.backup_get_async_es
+        super(BackgroundTestCase, self).tearDown()
+
+    def test_aexecute(self):
+        s = ParentIndexable.search_objects.s().full()
+        result = s.aexecute()
+        self.assertEqual(list(result.get(timeout=5)), [self.child, self.grandchild])
+        self.assertTrue(result.ready())
+        self.assertEqual(list(s), [self.child, self.grandchild])
+        self.assertEqual(s.acount().get(), 2)
+        self.assertEqual(len(self.es.searches), 1)
+
+    def test_acount(self):
+        self.assertEqual(ParentIndexable.search_objects.s().acount().get(timeout=5), 2)
+        self.assertEqual(self.es.searches[0]["size"], 0)
+
+    def test_aindex(self):
+        self.child.aindex().get(timeout=5)
+        self.assertEqual(self.es.documents, [self.child.extract_document()])
+        with indexing.batch() as batch:
+            result = self.child.aindex()
+            self.assertTrue(result.ready())
+            self.assertIsNone(result.get())
+            self.assertEqual(len(batch), 1)
+            batch.clear()
+
+    def test_abulk(self):
+        lines = []
+        for obj in (self.child, self.grandchild, self.child):
+            lines.extend(indexing.get_index_actions(obj))
+        lines.append(indexing.get_delete_action(ParentIndexable, 9999))
+        self.assertEqual(background.abulk(lines, chunk_size=3).get(timeout=5), 4)
+        self.assertEqual(len(self.es.documents), 3)
+        self.assertEqual(self.es.deleted, [("testapp_parentindexable", 9999)])
+        self.assertEqual(background.abulk([]).get(), 0)
+
+    def test_abulk_errors(self):
+        self.es.bulk = lambda body: {"items": [{"update": {"status": 400, "error": "MapperParsingException"}}]}
+        result = background.abulk(indexing.get_index_actions(self.child))
+        with self.assertRaises(elasticsearch.helpers.BulkIndexError):
+            result.get(timeout=5)
+
+
+class SearchCacheTestCase(TestCase):
+
+    def setUp(self):
+        super(SearchCacheTestCase, self).setUp()
+        self.backup_cache = settings.ELASTIMORPHIC_SEARCH_CACHE
+        self.backup_refresh_interval = settings.ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL
+        settings.ELASTIMORPHIC_SEARCH_CACHE = "default"
+        settings.ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL = 0
+        caching.get_search_cache().clear()
+        self.child = ChildIndexable(foo="Fighters", bar=69)
+        self.child.save(index=False)
+        self.es = FakeSearchES([{"_id": str(self.child.pk), "_type": self.child.get_mapping_type_name()}])
+        self.child.get_es = lambda: self.es
+        self.backup_get_es = PolymorphicS.get_es
+        PolymorphicS.get_es = lambda s, default_builder=None: self.es
+        self.backup_get_async_es = background.get_async_es
+        background.get_async_es = lambda *args, **kwargs: self.es
+
+    def tearDown(self):
+        PolymorphicS.get_es = self.backup_get_es
+        background.get_async_es = self.backup_get_async_es
+        settings.ELASTIMORPHIC_SEARCH_CACHE = self.backup_cache
+        settings.ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL = self.backup_refresh_interval
+        super(SearchCacheTestCase, self).tearDown()
+
+    def search(self):
+        return ParentIndexable.search_objects.s().instance_of(ChildIndexable).cached()
+
+    def test_cached(self):
+        self.assertEqual(list(self.search().full()), [self.child])
+        self.assertEqual(list(self.search().full()), [self.child])
+        self.assertEqual(len(self.es.searches), 1)
+        self.assertEqual(self.search().count(), 1)
+        self.assertEqual(self.search().count(), 1)
+        self.assertEqual(len(self.es.searches), 2)
+
+        list(self.search().query(foo="Fighters"))
+        list(ParentIndexable.search_objects.s().cached())
+        list(self.search().full()[:1])
+        self.assertEqual(len(self.es.searches), 5)
+
+    def test_not_cached(self):
+        s = ParentIndexable.search_objects.s()
+        list(s)
+        list(s._clone())
+        self.assertEqual(len(self.es.searches), 2)
+        settings.ELASTIMORPHIC_SEARCH_CACHE = None
+        list(self.search())
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 4)
+
+    def test_index_invalidates(self):
+        list(self.search())
+        self.child.index()
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 2)
+
+        separate = SeparateIndexable(junk="Testing")
+        separate.save(index=False)
+        separate.get_es = lambda: self.es
+        separate.index()
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 2)
+
+        batch = indexing.IndexingBatch()
+        batch.add(self.child)
+        batch.flush(es=self.es)
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 3)
+
+    def test_refresh_window(self):
+        settings.ELASTIMORPHIC_SEARCH_CACHE_REFRESH_INTERVAL = 60
+        self.child.index()
+        # the index may not show the change yet, so these aren't cached
+        list(self.search())
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 2)
+        self.assertEqual(self.search().acount().get(timeout=5), 1)
+        self.assertEqual(len(self.es.searches), 3)
+
+        generation_key = caching.get_generation_key(ParentIndexable.get_index_name())
+        cache = caching.get_search_cache()
+        cache.set(generation_key, cache.get(generation_key) - 61 * 1000000)
+        list(self.search())
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 4)
+
+    def test_evicted_generation(self):
+        list(self.search())
+        caching.get_search_cache().delete(caching.get_generation_key(ParentIndexable.get_index_name()))
+        list(self.search())
+        self.assertEqual(len(self.es.searches), 2)
+
+
+class ConnectionTestCase(TestCase):
+
+    def tearDown(self):
+        connection.reset_es()
+
+    def test_client_is_shared(self):
+        es = connection.get_es()
+        self.assertIs(es, connection.get_es())
+        self.assertIs(es, ParentIndexable.get_es())
+        self.assertIs(es, ParentIndexable.search_objects.es)
+        self.assertIs(es, ParentIndexable.search_objects.s().get_es())
+
+    def test_client_per_settings(self):
+        es = connection.get_es()
+        self.assertIsNot(es, connection.get_es(urls=["http://127.0.0.2:9200"]))
+        self.assertIsNot(es, connection.get_es(timeout=1))
+        self.assertIsNot(es, ParentIndexable.search_objects.s().es(timeout=1).get_es())
+
+    def test_client_not_shared_after_fork(self):
+        es = connection.get_es()
+        # pretend we're running in a forked child
+        connection._clients_pid = -1
+        self.assertIsNot(es, connection.get_es())
+
+
 class TestPolymorphicIndexableRegistry(TestCase):
     def test_registry_has_models(self):
         self.assertTrue(polymorphic_indexable_registry.all_models)
@@ -264,3 +1561,134 @@ class TestPolymorphicIndexableRegistry(TestCase):
         for name, klass in types.items():
             result_classes.add(klass)
         self.assertEqual(desired_classes, result_classes)
+
+    def test_ctype_table(self):
+        ctype_ids = dict(
+            (model, ContentType.objects.get_for_model(model, for_concrete_model=False).id)
+            for model in (ChildIndexable, GrandchildIndexable))
+        ContentType.objects.clear_cache()
+        polymorphic_indexable_registry.clear_ctypes()
+        # every registered class is looked up at once
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                polymorphic_indexable_registry.get_ctype_model(ctype_ids[ChildIndexable]), ChildIndexable)
+            self.assertEqual(
+                polymorphic_indexable_registry.get_ctype_id(GrandchildIndexable),
+                ctype_ids[GrandchildIndexable])
+        self.assertEqual(
+            polymorphic_indexable_registry.get_mapping_type_model("testapp_childindexable"),
+            ChildIndexable)
+
+    def test_stale_ctype(self):
+        from elastimorphic.serializers import ContentTypeField
+
+        ctype = ContentType.objects.create(name="gone", app_label="testapp", model="gone")
+        self.assertIsNone(polymorphic_indexable_registry.get_ctype_model(ctype.id))
+        self.assertEqual(ContentTypeField().to_native(ctype.id), "testapp_gone")
+
+
+class DocTypeTestCase(TestCase):
+
+    def test_doctype_is_compiled_once(self):
+        doctype = ChildIndexable.get_doctype()
+        names = [name for name, field in doctype.fields]
+        self.assertEqual(
+            sorted(names), ["bar", "foo", "id", "parentindexable_ptr_id", "polymorphic_ctype"])
+        for i in range(3):
+            self.assertIs(ChildIndexable.get_doctype(), doctype)
+            ChildIndexable.get_mapping()
+        self.assertEqual(len(ChildIndexable.get_doctype_class().fields), len(names))
+        # subclasses get their own
+        self.assertNotEqual(len(GrandchildIndexable.get_doctype().fields), len(names))
+
+        obj = ChildIndexable(foo="Fighters", bar=69)
+        obj.save(index=False)
+        document = Indexable.extract_document(obj)
+        self.assertEqual(document["bar"], 69)
+        self.assertEqual(document["foo"], "Fighters")
+
+    def test_polymorphic_ctype(self):
+        obj = DeclarativeIndexable(title="Fighters")
+        obj.save(index=False)
+        document = obj.extract_document()
+        self.assertEqual(document["polymorphic_ctype"], obj.polymorphic_ctype_id)
+        self.assertNotIn("polymorphic_ctype_id", document)
+        mapping = DeclarativeIndexable.get_mapping()["testapp_declarativeindexable"]
+        self.assertEqual(mapping["properties"]["polymorphic_ctype"], {"type": "integer"})
+        self.assertEqual(mapping["_all"], {"analyzer": "html"})
+        self.assertEqual(DeclarativeIndexable.get_document_sources()["polymorphic_ctype"], "polymorphic_ctype_id")
+        self.assertEqual(
+            list(DeclarativeIndexable.objects.values_list("polymorphic_ctype_id", flat=True)),
+            [obj.polymorphic_ctype_id])
+        fields, columns = bulk.get_columns(DeclarativeIndexable)
+        self.assertIn("polymorphic_ctype", columns)
+
+    def test_declared_mapping_is_not_changed(self):
+        class Declared(object):
+            _meta = ChildIndexable._meta
+
+            class Mapping(DocumentType):
+                exclude = ["id"]
+                bar = fields.IntegerField(store="yes")
+
+        declared_fields = list(Declared.Mapping.fields)
+        for i in range(3):
+            doctype = compile_doctype(Declared)
+            self.assertEqual(
+                sorted(name for name, field in doctype.fields),
+                ["bar", "foo", "parentindexable_ptr_id", "polymorphic_ctype"])
+        self.assertEqual(Declared.Mapping.fields, declared_fields)
+        self.assertEqual(Declared.Mapping.exclude, ["id"])
+        self.assertEqual(doctype.get_mapping()["properties"]["bar"], {"type": "integer", "store": "yes"})
+        self.assertEqual(doctype.get_mapping()["properties"]["foo"], {"type": "string"})
+
+    def test_compiled_extractor(self):
+        class UpperField(fields.StringField):
+            def to_es(self, value):
+                return value.upper()
+
+        extract = compile_extractor([
+            ("foo", fields.StringField()),
+            ("bar", fields.IntegerField()),
+            ("baz", fields.DateField()),
+            ("qux", UpperField()),
+            ("missing", fields.FloatField()),
+        ])
+        obj = ParentIndexable(foo=69)
+        obj.bar = "7"
+        obj.baz = datetime.date(2014, 4, 23)
+        obj.qux = "qux"
+        self.assertEqual(
+            extract(obj),
+            {"foo": u"69", "bar": 7, "baz": "2014-04-23", "qux": "QUX", "missing": None})
+
+    def test_nested_documents(self):
+        author = Author.objects.create(name="Dave")
+        obj = DeclarativeChildIndexable(title="Fighters", author=author)
+        obj.save(index=False)
+        self.assertEqual(obj.extract_document()["author"], {"name": "Dave"})
+        self.assertEqual(obj.extract_document()["title"], "Fighters")
+        properties = DeclarativeChildIndexable.get_mapping()["testapp_declarativechildindexable"]["properties"]
+        self.assertEqual(properties["author"], {"type": "object", "properties": {"name": {"type": "string"}}})
+        self.assertNotIn("author_id", properties)
+
+        obj.author = None
+        self.assertIsNone(obj.extract_document()["author"])
+
+        class Authors(object):
+            def all(self):
+                return [Author(name="Dave"), Author(name="Taylor")]
+
+        self.assertEqual(Author.Mapping().to_es(Authors()), [{"name": "Dave"}, {"name": "Taylor"}])
+
+    def test_prefetch_related_documents(self):
+        for name in ["Dave", "Taylor", "Nate"]:
+            DeclarativeChildIndexable(title="Fighters", author=Author.objects.create(name=name)).save(index=False)
+        DeclarativeIndexable(title="Fighters").save(index=False)
+        objs = list(DeclarativeIndexable.objects.all())
+        with self.assertNumQueries(1):
+            prefetch_related_documents(objs)
+        with self.assertNumQueries(0):
+            documents = [obj.extract_document() for obj in objs]
+        self.assertEqual([document.get("author") for document in documents], [
+            {"name": "Dave"}, {"name": "Taylor"}, {"name": "Nate"}, None])
@@ -0,0 +1,128 @@
+"""Microbenchmarks for the hot paths of elastimorphic.
+
+These don't need elasticsearch. They compare the current implementation against the naive
+approach it replaced, and since wall-clock timings depend on the machine they're run on, they
+only run when ELASTIMORPHIC_BENCHMARKS is set in the environment."""
+from __future__ import absolute_import
+
+import os
+import timeit
+import unittest
+
+import django
+from django.test import SimpleTestCase
+
+from elastimorphic.base import Indexable, PolymorphicMappingType, PolymorphicS
+from elastimorphic.conf import settings
+from elastimorphic.mappings import fields
+from elastimorphic.mappings.doctype import compile_extractor
+from elastimorphic.models import polymorphic_indexable_registry
+
+from elastimorphic.tests.testapp.models import (
+    ChildIndexable, GrandchildIndexable, ParentIndexable, SeparateIndexable)
+
+
+NUMBER = 2000
+
+benchmark = unittest.skipUnless(
+    os.environ.get("ELASTIMORPHIC_BENCHMARKS"), "set ELASTIMORPHIC_BENCHMARKS to run benchmarks")
+
+
+def best_of(func, number=NUMBER, repeat=3):
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+class SearchSetupBenchmark(SimpleTestCase):
+
+    def test_mapping_type_is_reused(self):
+        s1 = ParentIndexable.search_objects.s()
+        s2 = GrandchildIndexable.search_objects.s()
+        self.assertIs(s1.type, s2.type)
+        self.assertIs(s1.type, polymorphic_indexable_registry.get_mapping_type(ChildIndexable))
+        self.assertIs(s1.type.get_model(), ParentIndexable)
+
+    @benchmark
+    def test_search_setup_cost(self):
+        def uncached():
+            base_polymorphic_class = GrandchildIndexable.get_base_class()
+            type_ = type(
+                "%sMappingType" % base_polymorphic_class.__name__,
+                (PolymorphicMappingType,),
+                {"base_polymorphic_class": base_polymorphic_class})
+            return PolymorphicS(type_=type_).es(urls=settings.ES_URLS)
+
+        def cached():
+            return GrandchildIndexable.search_objects.s()
+
+        self.assertLess(best_of(cached), best_of(uncached))
+
+
+class ExtractionBenchmark(SimpleTestCase):
+
+    def setUp(self):
+        # a document as wide as a typical content model's, so the per-field overhead shows
+        self.doctype_fields = [
+            ("field%d" % i, fields.IntegerField() if i % 2 else fields.StringField())
+            for i in range(20)
+        ]
+        self.obj = type("Obj", (object,), dict((name, 69) for name, field in self.doctype_fields))()
+
+    def per_field(self):
+        document = {}
+        for name, field in self.doctype_fields:
+            document[name] = field.to_es(getattr(self.obj, name, None))
+        return document
+
+    def test_compiled_extractor(self):
+        extract = compile_extractor(self.doctype_fields)
+        self.assertEqual(extract(self.obj), self.per_field())
+
+    @benchmark
+    def test_compiled_extractor_cost(self):
+        extract = compile_extractor(self.doctype_fields)
+        self.assertLess(best_of(lambda: extract(self.obj)), best_of(self.per_field))
+
+
+class NullES(object):
+
+    def update(self, **kwargs):
+        pass
+
+
+@unittest.skipIf(django.VERSION < (1, 7), "the registry is only frozen by the app config")
+class RegistryBenchmark(SimpleTestCase):
+
+    def tearDown(self):
+        from django.apps import apps
+
+        polymorphic_indexable_registry.freeze(
+            [model for model in apps.get_models() if issubclass(model, Indexable)])
+
+    def compare(self, func):
+        """Times a function with the registry's lookup tables, and without them."""
+        frozen_time = best_of(func)
+        polymorphic_indexable_registry.clear_lookups()
+        self.assertLess(frozen_time, best_of(func))
+
+    def test_frozen_lookups(self):
+        self.assertEqual(polymorphic_indexable_registry.base_classes[GrandchildIndexable], ParentIndexable)
+        self.assertEqual(
+            ParentIndexable.get_mapping_type_names(exclude_base=True),
+            ["testapp_childindexable", "testapp_grandchildindexable"])
+        frozen = GrandchildIndexable.get_index_name()
+        polymorphic_indexable_registry.clear_lookups()
+        self.assertEqual(GrandchildIndexable.get_index_name(), frozen)
+        self.assertEqual(
+            ParentIndexable.get_mapping_type_names(exclude_base=True),
+            ["testapp_childindexable", "testapp_grandchildindexable"])
+
+    @benchmark
+    def test_instance_of(self):
+        s = ParentIndexable.search_objects.s()
+        self.compare(lambda: s.instance_of(ParentIndexable))
+
+    @benchmark
+    def test_index(self):
+        obj = SeparateIndexable(id=1, polymorphic_ctype_id=1, junk="Testing")
+        obj.get_es = lambda: NullES()
+        self.compare(obj.index)